@@ -15,44 +15,494 @@ and use the info to mount, read and write the USB.
 
 The test is performed by the following steps:
     1. create a random file, say a "source file"
-    2. mount the USB storage with the folder FOLDER_TO_MOUNT
-    3. copy the source file into FOLDER_TO_MOUNT by dd REPETITION_NUM times.
-    4. access the md5sum numbers of the files copied into FOLDER_TO_MOUNT
+    2. mount the USB storage with a temporary folder
+    3. copy the source file into the folder repetition_num times.
+    4. access the md5sum numbers of the files copied into the folder
     5. compare the md5sum numbers with the md5sum of the source file.
     6. report the result and return associated values back to plainbox.
+
+Importing the script has no side effect, the configuration is read from
+the environment by Config and the test is run by UsbRwTest.
 """
 
 import sys
 import subprocess
 import os
+import re
+import mmap
+import fcntl
+import time
+import random
+import itertools
 import collections
 import tempfile
 import logging
 import errno
+import shutil
+import math
 import contextlib
-from datetime import datetime
-from systemd import journal
-
-
-# PLAINBOX_SESSION_SHARE = os.environ.get('PLAINBOX_SESSION_SHARE', '')
-PLAINBOX_SESSION_SHARE = "/tmp/"
-FOLDER_TO_MOUNT = tempfile.mkdtemp(dir="/mnt/")
-REPETITION_NUM = 5  # number to repeat the read/write test units.
-# Prepare a random file which size is RANDOM_FILE_SIZE.
-RANDOM_FILE_SIZE = 104857600  # 100 MiB
-mem_bytes = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
-mem_mib = mem_bytes / (1024.0**2)
-# On systems with less than 1 GiB of RAM, only generate a 20 MiB file
-if mem_mib < 1200:
-    RANDOM_FILE_SIZE = 20971520
+import hashlib
+import threading
+import json
+import zlib
+import resource
+import array
+import statistics
+import concurrent.futures
+
 USB_INSERT_INFO = "usb_insert_info"
+# machine readable results of the run, saved in the session share
+RESULTS_FILE = "usb-rw-results.json"
+# speeds of the previous runs of every USB device, kept in the session share
+BASELINE_FILE = "usb-rw-baseline.json"
+# number of previous runs the baseline speed is the median of
+BASELINE_RUNS = 5
+# number of runs kept per device, for all configurations
+BASELINE_HISTORY = 100
+# highest signaling rate in Mbit/s of the devices of a USB version, from
+# the bcdUSB of their device descriptor
+USB_VERSION_SPEEDS = {1: 12, 2: 480, 3: 5000}
+# lowest signaling rate in Mbit/s of the device capabilities in the BOS
+# descriptor: SuperSpeed (0x03) and SuperSpeedPlus (0x0a); a SuperSpeed
+# device enumerated at high speed reports a bcdUSB of 2.10 but keeps them
+USB_CAPABILITY_SPEEDS = {0x03: 5000, 0x0A: 10000}
+# speed in MB/s a mass storage device can practically reach at a link
+# speed in Mbit/s, once the encoding and the protocol overheads are paid
+USB_PRACTICAL_SPEEDS = {
+    1.5: 0.1,
+    12: 1.0,
+    480: 40.0,
+    5000: 400.0,
+    10000: 900.0,
+    20000: 1800.0,
+}
+# size of the buffer used to stream files through hashlib
+HASH_BUFFER_SIZE = 1024 * 1024
+# the sectors of /sys/block/<dev>/stat are always 512 bytes
+STAT_SECTOR_SIZE = 512
+OFLAGS = {"sync": os.O_SYNC, "dsync": os.O_DSYNC, "direct": os.O_DIRECT}
+SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+# bounds of the number of repetitions of the adaptive sizing
+ADAPTIVE_MIN_REPETITIONS = 3
+ADAPTIVE_MAX_REPETITIONS = 20
+# two-sided 95% quantiles of Student's t-distribution, for 1 to 20 degrees
+# of freedom
+T_95 = (
+    12.706,
+    4.303,
+    3.182,
+    2.776,
+    2.571,
+    2.447,
+    2.365,
+    2.306,
+    2.262,
+    2.228,
+    2.201,
+    2.179,
+    2.160,
+    2.145,
+    2.131,
+    2.120,
+    2.110,
+    2.101,
+    2.093,
+    2.086,
+)
+# a throughput below this ratio of the speed before it is a cache boundary
+CACHE_DROP_RATIO = 0.7
+LATENCY_PERCENTILES = (50, 90, 99, 99.9)
+
+# device is a dict of the DeviceStats of the block devices, if sampled,
+# cpu_seconds the CPU time of the copy itself and cpu_usage a CpuStats
+IOResult = collections.namedtuple(
+    "IOResult",
+    ["bytes", "seconds", "speed", "device", "cpu_seconds", "cpu_usage"],
+    defaults=(None, None, None),
+)
+# unit_* are the CPU seconds of the thread running a unit, the CPU times of
+# all the CPUs of the system from /proc/stat follow, start and end are
+# perf_counter() timestamps
+CpuStats = collections.namedtuple(
+    "CpuStats",
+    [
+        "unit_user",
+        "unit_system",
+        "user",
+        "system",
+        "iowait",
+        "irq",
+        "softirq",
+        "idle",
+        "start",
+        "end",
+    ],
+)
+SYSTEM_CPU_FIELDS = CpuStats._fields[2:8]
+DeviceStats = collections.namedtuple(
+    "DeviceStats",
+    [
+        "seconds",
+        "read_bytes",
+        "write_bytes",
+        "speed",
+        "request_size",
+        "queue_depth",
+        "max_in_flight",
+        "utilization",
+    ],
+)
+RandomIOResult = collections.namedtuple(
+    "RandomIOResult", ["ops", "seconds", "iops", "latencies"]
+)
+Sample = collections.namedtuple("Sample", ["seconds", "bytes", "speed"])
+ScalingResult = collections.namedtuple(
+    "ScalingResult", ["streams", "write", "read"]
+)
+TestPlan = collections.namedtuple("TestPlan", ["file_size", "repetitions"])
+# latencies is an array of the seconds of every commit, in issue order
+CommitResult = collections.namedtuple(
+    "CommitResult", ["commits", "bytes", "seconds", "latencies"]
+)
+# the seconds of the phases of a write through the page cache, the umount
+# is None when the mount was reused and not unmounted
+BufferedResult = collections.namedtuple(
+    "BufferedResult",
+    [
+        "bytes",
+        "write_seconds",
+        "fsync_seconds",
+        "syncfs_seconds",
+        "umount_seconds",
+    ],
+    defaults=(None,),
+)
+PhaseResult = collections.namedtuple(
+    "PhaseResult", ["phase", "ops", "seconds", "rate"]
+)
+PartitionResult = collections.namedtuple(
+    "PartitionResult", ["partition", "write", "read"]
+)
+MountInfo = collections.namedtuple(
+    "MountInfo",
+    [
+        "device",
+        "root",
+        "mount_point",
+        "options",
+        "fs_type",
+        "source",
+        "super_options",
+    ],
+)
+
+
+class Config:
+    """
+    Class holding the configuration of a read/write test.
+
+    Every setting can be overridden with a USB_RWTEST_* environment
+    variable. Nothing is read before an instance is created.
+    """
+
+    def __init__(self, environ=None):
+        """
+        init method of class Config.
+
+        :param environ:
+            a mapping of the environment variables, os.environ by default
+        """
+        if environ is None:
+            environ = os.environ
+        # self.session_share = environ.get("PLAINBOX_SESSION_SHARE", "")
+        self.session_share = "/tmp/"
+        # number to repeat the read/write test units.
+        self.repetition_num = 5
+        # space separated partitions to test, the one found by the
+        # insertion test if empty
+        self.partitions = environ.get("USB_RWTEST_PARTITIONS", "").split()
+        # Prepare a random file which size is file_size.
+        self.file_size = 104857600  # 100 MiB
+        # number of threads verifying the files read by the read test, the
+        # timed reads themselves always run one after the other
+        self.verify_workers = int(
+            environ.get("USB_RWTEST_VERIFY_WORKERS", "1")
+        )
+        # "md5" compares the whole files, "crc32" or "blake2b" compares
+        # the digests of every verify_chunk_size chunk instead and finds
+        # the exact byte ranges that differ, the comparison stops at the
+        # first chunk that differs if verify_stop_early is set, the timed
+        # read before it still reads the whole file
+        self.verify = environ.get("USB_RWTEST_VERIFY", "md5")
+        self.verify_chunk_size = environ.get(
+            "USB_RWTEST_VERIFY_CHUNK_SIZE", "1M"
+        )
+        self.verify_stop_early = (
+            environ.get("USB_RWTEST_VERIFY_STOP_EARLY", "") == "1"
+        )
+        # size the files and the repetitions of every partition from a
+        # probe write, so the test takes about target_duration seconds and
+        # the 95% confidence interval of the speed is within confidence of
+        # it, never using more than space_fraction of the free space
+        self.adaptive = environ.get("USB_RWTEST_ADAPTIVE", "") == "1"
+        self.target_duration = float(
+            environ.get("USB_RWTEST_TARGET_DURATION", "60")
+        )
+        self.confidence = float(environ.get("USB_RWTEST_CONFIDENCE", "0.05"))
+        self.space_fraction = float(
+            environ.get("USB_RWTEST_SPACE_FRACTION", "0.5")
+        )
+        self.probe_size = environ.get("USB_RWTEST_PROBE_SIZE", "16M")
+        # verify every written file while the next one is written, instead
+        # of strictly writing all files and then reading them all
+        self.pipelined = environ.get("USB_RWTEST_PIPELINED", "") == "1"
+        # seconds between two samples of the I/O statistics of the device
+        self.stat_interval = float(
+            environ.get("USB_RWTEST_STAT_INTERVAL", "0.1")
+        )
+        # a speed lower than the baseline of the device by more than this
+        # ratio is a regression, which only logs a warning unless the
+        # regression action is "fail"
+        self.regression_threshold = float(
+            environ.get("USB_RWTEST_REGRESSION_THRESHOLD", "0.2")
+        )
+        self.regression_action = environ.get(
+            "USB_RWTEST_REGRESSION_ACTION", "warn"
+        )
+        # warn when the best speed of a device is below this fraction of
+        # what its USB link can practically carry
+        self.link_min_utilization = float(
+            environ.get("USB_RWTEST_LINK_MIN_UTILIZATION", "0.1")
+        )
+        # engine used to copy the source file to the target: "native"
+        # writes the test data from memory, "dd", "userspace" and "direct"
+        # (O_DIRECT) copy the file through userspace buffers,
+        # "copy_file_range" and "sendfile" copy it in the kernel
+        self.write_engine = environ.get("USB_RWTEST_WRITE_ENGINE", "native")
+        # block size of a single write, accepts dd style suffixes, e.g. 4K
+        self.block_size = environ.get("USB_RWTEST_BLOCK_SIZE", "1M")
+        # comma separated open flags of the target file, as dd's oflag=
+        self.write_oflag = environ.get("USB_RWTEST_WRITE_OFLAG", "sync")
+        # dd style input flags of the read test, "direct" bypasses the page
+        # cache with O_DIRECT instead of dropping the cached pages of the
+        # file
+        self.read_iflag = environ.get("USB_RWTEST_READ_IFLAG", "")
+        # space separated block sizes, if set the write and read tests are
+        # run once per block size on the same mount, e.g. "4K 64K 1M 4M"
+        self.sweep_block_sizes = environ.get("USB_RWTEST_SWEEP", "").split()
+        # write a single file for sustained_duration seconds or until it
+        # fills sustained_space_fraction of the free space, to find where
+        # the write cache of the device runs out
+        self.sustained = environ.get("USB_RWTEST_SUSTAINED", "") == "1"
+        self.sustained_duration = float(
+            environ.get("USB_RWTEST_SUSTAINED_DURATION", "600")
+        )
+        self.sustained_space_fraction = float(
+            environ.get("USB_RWTEST_SUSTAINED_SPACE_FRACTION", "0.5")
+        )
+        # amount of data written between two throughput samples
+        self.sample_size = environ.get("USB_RWTEST_SAMPLE_SIZE", "32M")
+        # run random reads and writes of random_io_size at aligned offsets
+        # instead of the sequential tests
+        self.random_io = environ.get("USB_RWTEST_RANDOM_IO", "") == "1"
+        self.random_io_size = environ.get("USB_RWTEST_RANDOM_IO_SIZE", "4K")
+        self.random_io_ops = int(
+            environ.get("USB_RWTEST_RANDOM_IO_OPS", "4096")
+        )
+        # dd style open flags of the random I/O test file, O_DIRECT by
+        # default so the operations are not served from the page cache
+        self.random_io_oflag = environ.get(
+            "USB_RWTEST_RANDOM_IO_OFLAG", "direct"
+        )
+        # space separated numbers of threads issuing I/O at the same time
+        self.queue_depths = environ.get("USB_RWTEST_QUEUE_DEPTH", "1").split()
+        # append commits small synchronous writes to a file instead of the
+        # sequential tests, their sizes cycle through commit_sizes and
+        # commit_sync is "dsync" (O_DSYNC) or "fdatasync" after each write
+        self.commit_latency = (
+            environ.get("USB_RWTEST_COMMIT_LATENCY", "") == "1"
+        )
+        self.commits = int(environ.get("USB_RWTEST_COMMITS", "1000"))
+        self.commit_sizes = environ.get(
+            "USB_RWTEST_COMMIT_SIZES", "4K 16K"
+        ).split()
+        self.commit_sync = environ.get("USB_RWTEST_COMMIT_SYNC", "dsync")
+        # space separated numbers of concurrent streams, if set every
+        # stream writes and then reads its own file at the same time as
+        # the others, e.g. "1 2 4 8"
+        self.stream_counts = environ.get("USB_RWTEST_STREAMS", "").split()
+        # write through the page cache instead of with write_oflag, and
+        # time the write() calls, the fsync() and syncfs() flushing them
+        # and the umount separately, the partition is mounted anew for
+        # every file
+        self.buffered = environ.get("USB_RWTEST_BUFFERED", "") == "1"
+        # create, fsync, stat, read and unlink metadata_files small files
+        # instead of the sequential tests, from metadata_threads threads
+        self.metadata = environ.get("USB_RWTEST_METADATA", "") == "1"
+        self.metadata_files = int(
+            environ.get("USB_RWTEST_METADATA_FILES", "1000")
+        )
+        self.metadata_file_size = environ.get(
+            "USB_RWTEST_METADATA_FILE_SIZE", "4K"
+        )
+        # maximum number of entries of every folder of the tree of files,
+        # at least 2, the tree gets deeper with the number of files
+        self.metadata_fanout = int(
+            environ.get("USB_RWTEST_METADATA_FANOUT", "16")
+        )
+        self.metadata_threads = int(
+            environ.get("USB_RWTEST_METADATA_THREADS", "1")
+        )
+        # test all partitions at the same time, each on its own mount
+        self.parallel = environ.get("USB_RWTEST_PARALLEL", "") == "1"
+        # test the partitions one by one and then all together, and
+        # compare the aggregate bandwidth of the devices sharing a host
+        # controller
+        self.aggregate = environ.get("USB_RWTEST_AGGREGATE", "") == "1"
+        # stream the test data from memory instead of a source file in
+        # /tmp, which may be a tmpfs, so the file size does not depend on
+        # the amount of RAM, only the engines copying a file need the
+        # source file and the modes writing their own data never use it
+        self.streamed = (
+            self.write_engine not in FILE_WRITE_ENGINES
+            or self.metadata
+            or self.sustained
+            or self.commit_latency
+        )
+        mem_bytes = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        mem_mib = mem_bytes / (1024.0**2)
+        # On systems with less than 1 GiB of RAM, only generate a 20 MiB file
+        if mem_mib < 1200 and not self.streamed:
+            self.file_size = 20971520
+
+    def mode(self):
+        """
+        get the mode of the run, the modes exclude each other.
+
+        :return: the name of the selected mode, "serial" if none is
+        :raise ValueError: if several modes are selected, if a setting the
+            selected mode does not support is set, or if the open flags or
+            the verification are invalid
+        """
+        selected = [
+            mode
+            for mode, is_set in (
+                ("sweep", bool(self.sweep_block_sizes)),
+                ("random_io", self.random_io),
+                ("commit_latency", self.commit_latency),
+                ("scaling", bool(self.stream_counts)),
+                ("buffered", self.buffered),
+                ("metadata", self.metadata),
+                ("sustained", self.sustained),
+                ("aggregate", self.aggregate),
+                ("parallel", self.parallel),
+            )
+            if is_set
+        ]
+        if len(selected) > 1:
+            raise ValueError(
+                "only one mode can be selected: {}".format(", ".join(selected))
+            )
+        mode = selected[0] if selected else "serial"
+        sequential = ("serial", "parallel", "aggregate", "sweep")
+        unsupported = [
+            variable
+            for variable, is_set, modes in (
+                ("USB_RWTEST_PIPELINED", self.pipelined, sequential),
+                ("USB_RWTEST_ADAPTIVE", self.adaptive, sequential[:3]),
+                (
+                    "USB_RWTEST_VERIFY_WORKERS",
+                    self.verify_workers != 1,
+                    sequential,
+                ),
+                (
+                    "USB_RWTEST_WRITE_ENGINE",
+                    self.write_engine != "native",
+                    sequential + ("scaling",),
+                ),
+                (
+                    "USB_RWTEST_VERIFY",
+                    self.verify != "md5",
+                    sequential + ("scaling", "buffered"),
+                ),
+            )
+            if is_set and mode not in modes
+        ]
+        if unsupported:
+            raise ValueError(
+                "the {} mode does not support {}".format(
+                    mode, ", ".join(unsupported)
+                )
+            )
+        if self.pipelined and self.verify_workers != 1:
+            raise ValueError(
+                "USB_RWTEST_PIPELINED reads the files from a single thread, "
+                "it does not support USB_RWTEST_VERIFY_WORKERS"
+            )
+        # the flags are only parsed once the files are written, check them
+        # before anything is mounted, dd checks its own oflag
+        flags = [("USB_RWTEST_READ_IFLAG", self.read_iflag)]
+        if self.write_engine != "dd" or self.adaptive:
+            flags.append(("USB_RWTEST_WRITE_OFLAG", self.write_oflag))
+        for variable, flag in flags:
+            try:
+                parse_oflag(flag)
+            except ValueError as e:
+                raise ValueError("{}: {}".format(variable, e))
+        if self.verify != "md5":
+            if self.verify not in CHUNK_DIGESTS:
+                raise ValueError(
+                    "unknown verification: {}".format(self.verify)
+                )
+            try:
+                parse_size(self.verify_chunk_size)
+            except ValueError as e:
+                raise ValueError("USB_RWTEST_VERIFY_CHUNK_SIZE: {}".format(e))
+        return mode
+
+
+def init_logger(session_share):
+    """
+    log everything to usb-rw.log in the session share and to stdout.
+
+    :param session_share: the folder of the log file
+    """
+    log_path = os.path.join(session_share, "usb-rw.log")
+    logging.basicConfig(level=logging.DEBUG, filename=log_path)
+    ch = logging.StreamHandler(sys.stdout)
+    ch.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    log = logging.getLogger("")
+    log.addHandler(ch)
+
+
+_hash_buffers = threading.local()
+
 
-log_path = os.path.join(PLAINBOX_SESSION_SHARE, "usb-rw.log")
-logging.basicConfig(level=logging.DEBUG, filename=log_path)
-ch = logging.StreamHandler(sys.stdout)
-ch.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
-log = logging.getLogger("")
-log.addHandler(ch)
+def hash_file(path, algorithm="md5"):
+    """
+    compute the digest of a file in-process.
+
+    The file is streamed through hashlib with readinto() and a buffer
+    that is allocated once per thread and reused for every file hashed
+    by that thread. hashlib releases the GIL while hashing large buffers,
+    so several files can be hashed concurrently from a thread pool.
+
+    :param path: the path of the file to hash
+    :param algorithm: a hashlib algorithm name
+    :return: the hex digest as a string
+    """
+    buf = getattr(_hash_buffers, "buf", None)
+    if buf is None:
+        buf = _hash_buffers.buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    digest = hashlib.new(algorithm)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            digest.update(view[:size])
+    return digest.hexdigest()
 
 
 class RandomData:
@@ -62,13 +512,45 @@ class RandomData:
     This class is ported from the original checkbox script.
     """
 
-    def __init__(self, size):
+    SEED = "104872948765827105728492766217823438120"
+    PHRASE = """
+        Lorem ipsum dolor sit amet, consectetuer adipiscing elit, sed diam
+        nonummy nibh euismod tincidunt ut laoreet dolore magna aliquam erat
+        volutpat. Ut wisi enim ad minim veniam, quis nostrud exerci tation
+        ullamcorper suscipit lobortis nisl ut aliquip ex ea commodo consequat.
+        Duis autem vel eum iriure dolor in hendrerit in vulputate velit esse
+        molestie consequat, vel illum dolore eu feugiat nulla facilisis at vero
+        eros et accumsan et iusto odio dignissim qui blandit praesent luptatum
+        zzril delenit augue duis dolore te feugait nulla facilisi.
+        """
+    # size of the buffer handed to each write() while tiling the pattern
+    WRITE_CHUNK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, size, streamed=False):
         """
         init method of class RandomData.
 
         :param size:
             an integer to decide the size of the generated random file in byte.
+        :param streamed:
+            if True, no file is created, the data is only provided by
+            readinto() and md5sum is left empty.
         """
+        self.size = size
+        block = self._generate_test_block()
+        self.period = len(block)
+        # tile the block up to a large write buffer so the file is written
+        # with a handful of big writes instead of one per line
+        self.block = block * max(1, self.WRITE_CHUNK_SIZE // self.period)
+        self.md5sum = ""
+        # digests of the chunks of the data, by chunk size and algorithm
+        self._chunk_digests = {}
+        self._chunk_digests_lock = threading.Lock()
+        if streamed:
+            self.tfile = None
+            self.path = ""
+            self.name = "tmp" + os.urandom(4).hex()
+            return
         self.tfile = tempfile.NamedTemporaryFile(delete=False)
         self.path = ""
         self.name = ""
@@ -76,47 +558,368 @@ class RandomData:
         self._write_test_data_file(size)
 
     def _generate_test_data(self):
-        seed = "104872948765827105728492766217823438120"
-        phrase = """
-        Lorem ipsum dolor sit amet, consectetuer adipiscing elit, sed diam
-        nonummy nibh euismod tincidunt ut laoreet dolore magna aliquam erat
-        volutpat. Ut wisi enim ad minim veniam, quis nostrud exerci tation
-        ullamcorper suscipit lobortis nisl ut aliquip ex ea commodo consequat.
-        Duis autem vel eum iriure dolor in hendrerit in vulputate velit esse
-        molestie consequat, vel illum dolore eu feugiat nulla facilisis at vero
-        eros et accumsan et iusto odio dignissim qui blandit praesent luptatum
-        zzril delenit augue duis dolore te feugait nulla facilisi.
-        """
-        words = phrase.replace("\n", "").split()
+        words = self.PHRASE.replace("\n", "").split()
         word_deque = collections.deque(words)
-        seed_deque = collections.deque(seed)
+        seed_deque = collections.deque(self.SEED)
         while True:
             yield " ".join(list(word_deque))
             word_deque.rotate(int(seed_deque[0]))
             seed_deque.rotate(1)
 
-    def _write_test_data_file(self, size):
+    def _generate_test_block(self):
+        """
+        build one full period of the test data stream.
+
+        Every line is a rotation of the same words, and the rotation only
+        depends on the word and seed deques, so both of them are back to
+        their initial state after a fixed number of lines. Repeating this
+        block yields exactly the same bytes as _generate_test_data().
+
+        :return: the bytes of one period of the test data stream
+        """
+        num_words = len(self.PHRASE.split())
+        total_rotation = sum(int(digit) for digit in self.SEED)
+        num_lines = (
+            len(self.SEED) * num_words // math.gcd(total_rotation, num_words)
+        )
         data = self._generate_test_data()
-        while os.path.getsize(self.tfile.name) < size:
-            self.tfile.write(next(data).encode("UTF-8"))
+        return "".join(next(data) for _ in range(num_lines)).encode("UTF-8")
+
+    def _write_test_data_file(self, size):
+        # hash the data while it is written, so the source file never has
+        # to be read back to get its digest
+        digest = hashlib.md5()
+        remaining = size
+        while remaining > 0:
+            chunk = self.block[:remaining]
+            self.tfile.write(chunk)
+            digest.update(chunk)
+            remaining -= len(chunk)
         self.tfile.close()
+        self.md5sum = digest.hexdigest()
+        return self
+
+    def chunk_digests(self, chunk_size, algorithm):
+        """
+        get the digests of the consecutive chunks of the test data.
+
+        They are computed on the first call only.
+
+        :param chunk_size: the size of the chunks in bytes, the last chunk
+            may be shorter
+        :param algorithm: a key of CHUNK_DIGESTS
+        :return: a list of digests, one per chunk
+        """
+        with self._chunk_digests_lock:
+            key = (chunk_size, algorithm)
+            if key not in self._chunk_digests:
+                digest = CHUNK_DIGESTS[algorithm]
+                buf = bytearray(chunk_size)
+                view = memoryview(buf)
+                digests = []
+                offset = 0
+                while offset < self.size:
+                    size = self.readinto(buf, offset)
+                    digests.append(digest(view[:size]))
+                    offset += size
+                self._chunk_digests[key] = digests
+            return self._chunk_digests[key]
+
+    def readinto(self, buf, offset):
+        """
+        copy the test data found at an offset into a buffer.
+
+        The data is periodic, so any offset is served from the tiled
+        block without generating or reading what comes before it.
+
+        :param buf: a writable buffer, filled from its start
+        :param offset: the offset in the test data to copy from
+        :return: the number of bytes copied, 0 at the end of the data
+        """
+        size = max(0, min(len(buf), self.size - offset))
+        view = memoryview(self.block)
+        filled = 0
+        while filled < size:
+            start = (offset + filled) % self.period
+            chunk = min(size - filled, len(view) - start)
+            buf[filled : filled + chunk] = view[start : start + chunk]
+            filled += chunk
+        return size
+
+
+class KernelLogScanner:
+    """
+    Class to find I/O errors of a block device in the kernel log.
+
+    Not able to run dmesg in strict confinement mode, so the kernel
+    messages are read from the journal instead. A single reader is kept
+    open and positioned at the end of the journal, every scan() only
+    drains the entries logged since the previous one. The units running
+    at the same time may share a scanner, scan() is serialized.
+    """
+
+    def __init__(self, devices):
+        """
+        init method of class KernelLogScanner.
+
+        :param devices:
+            a list of block device names the errors are attributed to,
+            e.g. ["sdb1", "sdb"]
+        """
+        self.devices = devices
+        self.pattern = re.compile(
+            r"\b(?:{})\b".format("|".join(map(re.escape, devices)))
+        )
+        # only needed once a test runs, and slow to import
+        from systemd import journal
+
+        self.reader = journal.Reader()
+        self.reader.this_boot()
+        self.reader.add_match(_TRANSPORT="kernel")
+        self.reader.seek_tail()
+        # step back onto the last entry so the next one is the first new
+        self.reader.get_previous()
+        self._lock = threading.Lock()
+
+    def scan(self):
+        """
+        read the kernel messages logged since the last scan.
+
+        I/O errors of other devices are logged but not returned.
+
+        :return: a list of the I/O error messages of the devices
+        """
+        errors = []
+        with self._lock:
+            # pick up journal files rotated since the last scan
+            self.reader.process()
+            for entry in self.reader:
+                message = entry.get("MESSAGE", "")
+                if "I/O error" not in message:
+                    continue
+                if self.pattern.search(message):
+                    errors.append(message)
+                else:
+                    logging.warning("I/O error on another device: %s", message)
+        return errors
+
+    def close(self):
+        self.reader.close()
+
+
+def check_io_errors(log_scanner):
+    """
+    exit if the kernel logged I/O errors of the devices since the last
+    scan.
+
+    :param log_scanner: the KernelLogScanner of the devices under test
+    """
+    io_errors = log_scanner.scan()
+    if io_errors:
+        print("ERROR: I/O errors found in dmesg")
+        for message in io_errors:
+            print("  {}".format(message))
+        sys.exit(1)
+    logging.debug("No I/O errors found in dmesg")
+
+
+def block_devices(path):
+    """
+    find the block device holding a path.
+
+    :param path: a path on a mounted filesystem
+    :return: a list with the name of the device, followed by the name of
+        its disk if the device is a partition, e.g. ["sdb1", "sdb"]
+    """
+    st_dev = os.stat(path).st_dev
+    sys_path = os.path.realpath(
+        "/sys/dev/block/{}:{}".format(os.major(st_dev), os.minor(st_dev))
+    )
+    devices = [os.path.basename(sys_path)]
+    if os.path.exists(os.path.join(sys_path, "partition")):
+        devices.append(os.path.basename(os.path.dirname(sys_path)))
+    return devices
+
+
+class IoStatSampler:
+    """
+    Class to sample the I/O statistics of block devices in the background.
+
+    The stat files of the devices in sysfs are read by a thread every
+    interval seconds between the start and the end of a with block, the
+    counters only tell what the devices did, whatever the filesystem and
+    the page cache did on top of them.
+    """
+
+    def __init__(self, devices, interval):
+        """
+        init method of class IoStatSampler.
+
+        :param devices:
+            a list of block device names, e.g. ["sdb1", "sdb"], devices
+            without statistics are ignored
+        :param interval: the number of seconds between two samples
+        """
+        self.paths = collections.OrderedDict()
+        for device in devices:
+            path = os.path.join("/sys/class/block", device, "stat")
+            if os.path.exists(path):
+                self.paths[device] = path
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        fields = {}
+        for device, path in self.paths.items():
+            with open(path) as stat:
+                fields[device] = [int(field) for field in stat.read().split()]
+        self.samples.append((time.perf_counter(), fields))
+
+    def stats(self):
+        """
+        :return: a dict of the DeviceStats of every device over the whole
+            sampling, the speed is in MB/s and the utilization in percent
+        """
+        (start, first), (end, last) = self.samples[0], self.samples[-1]
+        milliseconds = (end - start) * 1e3
+        stats = {}
+        for device in self.paths:
+            # see Documentation/block/stat.rst of the kernel
+            delta = [b - a for a, b in zip(first[device], last[device])]
+            requests = delta[0] + delta[4]
+            read_bytes = delta[2] * STAT_SECTOR_SIZE
+            write_bytes = delta[6] * STAT_SECTOR_SIZE
+            stats[device] = DeviceStats(
+                milliseconds / 1e3,
+                read_bytes,
+                write_bytes,
+                (
+                    (read_bytes + write_bytes) / milliseconds / 1e3
+                    if milliseconds
+                    else 0.0
+                ),
+                (read_bytes + write_bytes) / requests if requests else 0.0,
+                delta[10] / milliseconds if milliseconds else 0.0,
+                max(fields[device][8] for _, fields in self.samples),
+                (
+                    min(delta[9] / milliseconds * 100, 100.0)
+                    if milliseconds
+                    else 0.0
+                ),
+            )
+        return stats
+
+
+class CpuMeter:
+    """
+    Class to measure the CPU time spent during a with block.
+
+    The resource usage of the calling thread tells what the test cost,
+    without the other units running at the same time nor the sampling
+    threads. Child processes are not included, the ended children of the
+    process cannot be told apart by thread, dd_write() reports the CPU
+    time of dd in IOResult.cpu_seconds instead. The CPU times of
+    /proc/stat tell what the whole system did, e.g. the interrupt handling
+    of the USB host controller. The meter has to be entered and exited by
+    the same thread.
+    """
+
+    def __init__(self):
+        """
+        init method of class CpuMeter.
+        """
+        self.samples = []
+
+    def __enter__(self):
+        self._sample()
         return self
 
+    def __exit__(self, *exc_info):
+        self._sample()
+
+    def _sample(self):
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        with open("/proc/stat") as stat:
+            # cpu user nice system idle iowait irq softirq ...
+            ticks = [int(field) for field in stat.readline().split()[1:8]]
+        self.samples.append(
+            (usage.ru_utime, usage.ru_stime, ticks, time.perf_counter())
+        )
+
+    def stats(self):
+        """
+        :return: a CpuStats of the CPU seconds spent during the with block
+        """
+        (user, system, first, start), (end_user, end_system, last, end) = (
+            self.samples[0],
+            self.samples[-1],
+        )
+        hertz = os.sysconf("SC_CLK_TCK")
+        delta = [(b - a) / hertz for a, b in zip(first, last)]
+        return CpuStats(
+            end_user - user,
+            end_system - system,
+            delta[0] + delta[1],
+            delta[2],
+            delta[4],
+            delta[5],
+            delta[6],
+            delta[3],
+            start,
+            end,
+        )
+
+
+def format_device_stats(device, stats):
+    """
+    :param device: the name of a block device, e.g. sdb
+    :param stats: a DeviceStats of the device
+    :return: a one line summary of the statistics
+    """
+    return (
+        "device {}: {:.3f} MB/s, {:.1f} KiB per request, "
+        "queue depth {:.2f} (max {}), {:.1f}% busy".format(
+            device,
+            stats.speed,
+            stats.request_size / 1024,
+            stats.queue_depth,
+            stats.max_in_flight,
+            stats.utilization,
+        )
+    )
+
 
-def get_partition_info():
+def get_partition_info(session_share):
     """
     get partition info.
 
     use a cache file provided by usb insertion test
     to get the partition to mount later
 
+    :param session_share: the folder of the cache file
     return: a string which is a partition name. e.g. sdb1
     """
-    if not PLAINBOX_SESSION_SHARE:
+    if not session_share:
         logging.error("no PLAINBOX_SESSION_SHARE is defined.")
         sys.exit(1)
     file_lines = ""
-    info_path = os.path.join(PLAINBOX_SESSION_SHARE, USB_INSERT_INFO)
+    info_path = os.path.join(session_share, USB_INSERT_INFO)
     try:
         with open(info_path, "r") as file_usb_insert_info:
             file_lines = file_usb_insert_info.readlines()
@@ -137,236 +940,3167 @@ def get_partition_info():
     return partition
 
 
-def run_read_write_test():
-    """try to mount the partition candidates."""
-    # random file as a benchmark, a "source" file
-    with gen_random_file() as random_file:
-        # initialize the necessary tasks before performing read/write test
-        partitions = os.environ.get("USB_RWTEST_PARTITIONS", "").split()
-        if not partitions:
-            partitions = [get_partition_info()]
-        for partition in partitions:
-            with mount_usb_storage(partition):
-                # write test
-                write_test(random_file)
-                # already write some data into the target
-                # so let's read it to perform the read test
-                # and validate the writing correctness
-                read_test(random_file)
+class UsbRwTest:
+    """
+    Class to run the read/write tests of USB storage partitions.
+    """
 
+    def __init__(self, config=None):
+        """
+        init method of class UsbRwTest.
 
-@contextlib.contextmanager
-def mount_usb_storage(partition):
-    """
-    initialize the configuration so we could get ready to test jobs.
+        :param config: a Config object, read from the environment by default
+        """
+        self.config = config or Config()
+        self._folder_to_mount = None
+        # metrics of every mount of the partitions
+        self.mounts = []
 
-    get everything ready to have the read/write test, including
-    1. create a temporary folder used for mounting devices
-    2. un-mount the target device at the very beginning if it was mounted
+    @property
+    def folder_to_mount(self):
+        """the default mount point, created on first use."""
+        if self._folder_to_mount is None:
+            self._folder_to_mount = tempfile.mkdtemp(dir="/mnt/")
+        return self._folder_to_mount
 
-    TODO: this function should be smarter and not completed enough
-    """
-    logging.debug("try to mount usb storage for testing")
+    @contextlib.contextmanager
+    def gen_random_file(self):
+        """
+        generate a random file which size is config.file_size.
 
-    try:
-        device_to_mount = os.path.join("/dev", partition)
-        # use pipe so I could hide message like
-        # "umount: /tmp/tmpjzwb6lys: not mounted"
-        subprocess.call(["umount", FOLDER_TO_MOUNT], stderr=subprocess.PIPE)
-        # mount the target device/partition
-        # if the return code of the shell command is non-zero,
-        # means something wrong.
-        # quit this script and return a non-zero value to plainbox
-        if subprocess.call(["mount", device_to_mount, FOLDER_TO_MOUNT]):
-            logging.error(
-                "mount %s on %s failed.", device_to_mount, FOLDER_TO_MOUNT
+        :return: a RandomData object
+        """
+        logging.debug("generating a random file")
+        try:
+            random_file = RandomData(
+                self.config.file_size, self.config.streamed
             )
+            yield random_file
+        finally:
+            logging.info("Remove temporary folders and files.")
+            # delete the mount folder, if a test created it
+            if self._folder_to_mount is not None:
+                try:
+                    os.rmdir(self._folder_to_mount)
+                except OSError:
+                    logging.warning(
+                        "Failed to remove %s (mount folder not empty)."
+                        % self._folder_to_mount
+                    )
+                self._folder_to_mount = None
+            # delete the random file (source file of a writing test)
+            if random_file.tfile is not None:
+                os.unlink(random_file.tfile.name)
+
+    def run(self):
+        """try to mount the partition candidates."""
+        try:
+            mode = self.config.mode()
+        except ValueError as e:
+            logging.error("invalid configuration: %s", e)
             sys.exit(1)
-        else:
-            logging.debug(
-                "mount %s on %s successfully.",
-                device_to_mount,
-                FOLDER_TO_MOUNT,
+        # random file as a benchmark, a "source" file
+        with self.gen_random_file() as random_file:
+            # initialize the necessary tasks before performing read/write test
+            partitions = self.config.partitions
+            if not partitions:
+                partitions = [get_partition_info(self.config.session_share)]
+            report = {
+                "config": {
+                    "repetition_num": self.config.repetition_num,
+                    "file_size": self.config.file_size,
+                    "block_size": self.config.block_size,
+                    "write_engine": self.config.write_engine,
+                    "write_oflag": self.config.write_oflag,
+                    "read_iflag": self.config.read_iflag,
+                    "pipelined": self.config.pipelined,
+                    "verify": self.config.verify,
+                    "adaptive": self.config.adaptive,
+                },
+                "start_time": time.time(),
+            }
+            # (block size, PartitionResult) tuples compared with the
+            # baseline of their device
+            measured = []
+            # the test method, called with the random file and a partition,
+            # and the report function of the modes testing the partitions
+            # one by one
+            partition_modes = {
+                "sweep": (self.block_size_sweep, sweep_report),
+                "random_io": (self.random_io_test, random_io_report),
+                "commit_latency": (
+                    lambda random_file, partition: self.commit_latency_test(
+                        partition
+                    ),
+                    commit_report,
+                ),
+                "scaling": (self.scaling_test, scaling_report),
+                "buffered": (self.buffered_test, buffered_report),
+                "metadata": (self.metadata_test, metadata_report),
+                "sustained": (self.sustained_write_test, sustained_report),
+            }
+            if mode in partition_modes:
+                test, device_report = partition_modes[mode]
+                report["mode"] = mode
+                report["devices"] = []
+                for partition in partitions:
+                    results = test(random_file, partition)
+                    report["devices"].append(device_report(partition, results))
+                    if mode == "sweep":
+                        measured.extend(results)
+            elif mode == "aggregate" and len(partitions) > 1:
+                solo_results = [
+                    self.partition_test(random_file, partition)
+                    for partition in partitions
+                ]
+                concurrent_results = self.parallel_test(
+                    random_file, partitions
+                )
+                report_aggregate_bandwidth(solo_results, concurrent_results)
+                measured = [
+                    (self.config.block_size, result) for result in solo_results
+                ]
+                report["mode"] = "aggregate"
+                report["devices"] = [
+                    partition_report(result) for result in solo_results
+                ]
+                report["concurrent_devices"] = [
+                    partition_report(result) for result in concurrent_results
+                ]
+            elif mode == "parallel" and len(partitions) > 1:
+                report["mode"] = "parallel"
+                results = self.parallel_test(random_file, partitions)
+                measured = [
+                    (self.config.block_size, result) for result in results
+                ]
+                report["devices"] = [
+                    partition_report(result) for result in results
+                ]
+            else:
+                if mode != "serial":
+                    logging.warning(
+                        "the %s mode needs several partitions, testing %s "
+                        "alone",
+                        mode,
+                        partitions[0],
+                    )
+                report["mode"] = "serial"
+                measured = [
+                    (
+                        self.config.block_size,
+                        self.partition_test(random_file, partition),
+                    )
+                    for partition in partitions
+                ]
+                report["devices"] = [
+                    partition_report(result) for _, result in measured
+                ]
+            report["baseline"] = self.compare_with_baseline(
+                report["mode"], measured
             )
-        yield
-    finally:
-        logging.info("context manager exit: unmount USB storage")
-        if subprocess.call(["umount", FOLDER_TO_MOUNT]):
-            logging.warning("umount %s failed." % FOLDER_TO_MOUNT)
-        else:
-            logging.info("umount %s successfully." % FOLDER_TO_MOUNT)
-
-
-def read_test(random_file):
-    """perform the read test."""
-    logging.debug("===================")
-    logging.debug("reading test begins")
-    logging.debug("===================")
-    read_test_list = []
-    for idx in range(REPETITION_NUM):
-        read_test_list.append(read_test_unit(random_file, str(idx)))
-    print("PASS: all reading tests passed.")
+            report["links"] = self.check_links(measured)
+            report["end_time"] = time.time()
+            report["mounts"] = self.mounts
+            report["peak_rss"] = peak_rss()
+            print(
+                "Peak RSS: {self:.1f} MiB, {children:.1f} MiB for the "
+                "children".format(
+                    **{
+                        who: kib / 1024
+                        for who, kib in report["peak_rss"].items()
+                    }
+                )
+            )
+            save_results(report, self.config.session_share)
+        if self.config.regression_action == "fail" and any(
+            comparison["regressed"] for comparison in report["baseline"]
+        ):
+            print("ERROR: throughput regressed from the baseline")
+            sys.exit(1)
 
+    def compare_with_baseline(self, mode, measured):
+        """
+        compare the speeds of USB devices with the ones of previous runs.
 
-def read_test_unit(random_source_file, idx=""):
-    """
-    perform the read test.
+        The baseline of a direction is the median speed of the last
+        BASELINE_RUNS runs of the same device with the same configuration,
+        the device being identified by its vendor, product and serial. A
+        speed below the baseline by more than config.regression_threshold
+        is a regression. The speeds of runs without regression are added
+        to the baseline store in the session share, so a lasting
+        regression is reported on every run.
 
-    :param random_source_file: a RandomData object
-    :param idx: a idx to label the files to be compared with the source file.
-          It is an int string, "1", "2", "3", ......etc.
-    """
-    # access the temporary file
-    path_random_file = (
-        os.path.join(
-            FOLDER_TO_MOUNT, os.path.basename(random_source_file.tfile.name)
-        )
-        + idx
-    )
-    # get the md5sum of the temp random files to compare
-    process = subprocess.Popen(
-        ["md5sum", path_random_file], stdout=subprocess.PIPE
-    )
-    tfile_md5sum = process.communicate()[0].decode().split(" ")[0]
-    # get the md5sum of the source random file
-    process = subprocess.Popen(
-        ["md5sum", random_source_file.tfile.name], stdout=subprocess.PIPE
-    )
-    source_md5sum = process.communicate()[0].decode().split(" ")[0]
-    logging.debug("%s %s (verified)" % (tfile_md5sum, path_random_file))
-    logging.debug(
-        "%s %s (source)", source_md5sum, random_source_file.tfile.name
-    )
-    # Clean the target file
-    os.remove(path_random_file)
-    # verify the md5sum
-    if tfile_md5sum == source_md5sum:
-        print(
-            "PASS: READING TEST: %s passes md5sum comparison."
-            % path_random_file
-        )
-    else:
-        # failed in the reading test
-        # tell plainbox the failure code
-        logging.warning(
-            "FAIL: READING TEST: %s failed in md5sum comparison."
-            % path_random_file
-        )
-        sys.exit(1)
+        :param mode: the mode of the run, e.g. "serial"
+        :param measured: a list of (block size, PartitionResult) tuples
+        :return: a list of dicts, one per device and direction compared
+        """
+        store = load_baseline(self.config.session_share)
+        comparisons = []
+        for block_size, result in measured:
+            identity = usb_device_identity(result.partition)
+            if identity is None:
+                logging.info(
+                    "%s is not a USB device, no baseline", result.partition
+                )
+                continue
+            key = "{vendor}:{product}:{serial}".format(**identity)
+            entry = store.setdefault(key, dict(identity, runs=[]))
+            signature = " ".join(
+                str(value)
+                for value in (
+                    mode,
+                    self.config.file_size,
+                    block_size,
+                    self.config.write_engine,
+                    self.config.write_oflag,
+                    self.config.read_iflag,
+                )
+            )
+            history = [
+                run for run in entry["runs"] if run["config"] == signature
+            ][-BASELINE_RUNS:]
+            speeds = {}
+            regressed = False
+            for direction in PartitionResult._fields[1:]:
+                speeds[direction] = average_speed(getattr(result, direction))
+                if not history:
+                    continue
+                baseline = statistics.median(run[direction] for run in history)
+                ratio = speeds[direction] / baseline if baseline else 1.0
+                comparison = {
+                    "partition": result.partition,
+                    "device": key,
+                    "block_size": block_size,
+                    "direction": direction,
+                    "speed": speeds[direction],
+                    "baseline": baseline,
+                    "runs": len(history),
+                    "regressed": ratio < 1 - self.config.regression_threshold,
+                }
+                comparisons.append(comparison)
+                print(
+                    "{} {} speed of {}: {:.3f} MB/s, baseline {:.3f} MB/s "
+                    "over {} runs ({:.1f}%)".format(
+                        block_size,
+                        direction,
+                        key,
+                        speeds[direction],
+                        baseline,
+                        len(history),
+                        ratio * 100,
+                    )
+                )
+                if comparison["regressed"]:
+                    regressed = True
+                    logging.warning(
+                        "%s speed of %s (%s) regressed by more than %.0f%%",
+                        direction,
+                        result.partition,
+                        key,
+                        self.config.regression_threshold * 100,
+                    )
+            if not regressed:
+                entry["runs"].append(
+                    dict(speeds, time=time.time(), config=signature)
+                )
+                del entry["runs"][:-BASELINE_HISTORY]
+        save_baseline(store, self.config.session_share)
+        return comparisons
 
+    def check_links(self, measured):
+        """
+        compare the speeds of USB devices with the rate of their links.
 
-def write_test(random_file):
-    """perform a writing test."""
-    logging.debug("===================")
-    logging.debug("writing test begins")
-    logging.debug("===================")
-    write_speed_list = []
-    for idx in range(REPETITION_NUM):
-        write_speed_list.append(write_test_unit(random_file, str(idx)))
-    average_speed = sum(write_speed_list) / REPETITION_NUM
-    file_size_in_mb = RANDOM_FILE_SIZE / (1024 * 1024)
-    print(
-        "Average writing speed is: {:.3f} MB/s "
-        "({}x{} MB files were written)".format(
-            average_speed, REPETITION_NUM, file_size_in_mb
-        )
-    )
+        A warning is logged when a device negotiated a lower speed than
+        the USB version of its descriptor supports, e.g. a USB 3 device
+        on a USB 2 port or cable, and when its best speed is below
+        config.link_min_utilization of what the link practically carries.
 
+        :param measured: a list of (block size, PartitionResult) tuples
+        :return: a list of dicts, one per USB device
+        """
+        speeds = collections.OrderedDict()
+        for _, result in measured:
+            partition_speeds = speeds.setdefault(result.partition, {})
+            for direction in PartitionResult._fields[1:]:
+                partition_speeds[direction] = max(
+                    partition_speeds.get(direction, 0.0),
+                    average_speed(getattr(result, direction)),
+                )
+        links = []
+        for partition, partition_speeds in speeds.items():
+            link = usb_link(partition)
+            if link is None:
+                logging.info("%s is not a USB device, no link", partition)
+                continue
+            link["partition"] = partition
+            practical = USB_PRACTICAL_SPEEDS.get(link["speed"])
+            for direction, speed in partition_speeds.items():
+                link[direction] = {
+                    "speed": speed,
+                    "utilization": speed * 8 / link["speed"] * 100,
+                    "practical_utilization": (
+                        speed / practical * 100 if practical else None
+                    ),
+                }
+                print(
+                    "{} {} speed: {:.3f} MB/s, {:.1f}% of its {:g} Mbit/s "
+                    "USB link".format(
+                        partition,
+                        direction,
+                        speed,
+                        link[direction]["utilization"],
+                        link["speed"],
+                    )
+                )
+            if link["speed"] < link["descriptor_speed"]:
+                logging.warning(
+                    "%s runs at %g Mbit/s, its descriptor supports %g "
+                    "Mbit/s, %s",
+                    partition,
+                    link["speed"],
+                    link["descriptor_speed"],
+                    (
+                        "its host controller only supports %g Mbit/s"
+                        % link["controller_speed"]
+                        if link["controller_speed"] < link["descriptor_speed"]
+                        else "check the port, the hubs (%g Mbit/s) and the "
+                        "cable" % link["hub_speed"]
+                    ),
+                )
+            best = max(partition_speeds.values())
+            if (
+                practical
+                and best < practical * self.config.link_min_utilization
+            ):
+                logging.warning(
+                    "%s reaches %.3f MB/s, far below the %.0f MB/s a "
+                    "%g Mbit/s link practically carries",
+                    partition,
+                    best,
+                    practical,
+                    link["speed"],
+                )
+            links.append(link)
+        return links
 
-def write_test_unit(random_file, idx=""):
-    """
-    perform the writing test.
+    def partition_test(self, random_file, partition, folder=None):
+        """
+        mount a partition and run the write and read tests on it.
 
-    :param random_file: a RandomData object created to be written
-    :return: a float in MB/s to denote writing speed
-    """
-    # Not able to run dmesg in strict confinement mode.
-    # Therefore, we check the journal log after a certain timestamp.
-    check_time = datetime.now().timestamp()
-    target_file = (
-        os.path.join(FOLDER_TO_MOUNT, os.path.basename(random_file.tfile.name))
-        + idx
-    )
-    process = subprocess.Popen(
-        [
-            "dd",
-            "if=" + random_file.tfile.name,
-            "of=" + target_file,
-            "bs=1M",
-            "oflag=sync",
-        ],
-        stderr=subprocess.STDOUT,
-        stdout=subprocess.PIPE,
-    )
-    logging.debug("Apply command: %s" % process.args)
-    # will get something like
-    # ['2048+1 records in', '2048+1 records out',
-    # '1049076 bytes (1.0 MB) copied, 0.00473357 s, 222 MB/s', '']
-    list_dd_message = process.communicate()[0].decode().split("\n")
-    logging.debug(list_dd_message)
-    try:
-        dd_speed = float(list_dd_message[2].split(" ")[-2])
-    except ValueError:
-        # Example:
-        # ['dd: writing to ‘/tmp/tmp08osy45j/tmpnek46on30’: Input/output error'
-        # , '38913+0 records in', '38912+0 records out', '19922944 bytes
-        # (20 MB) copied, 99.647 s, 200 kB/s', '']
-        print("ERROR: {}".format(list_dd_message))
-        sys.exit(1)
-    journal_log = journal.Reader()
-    # lp:1852510 - check there weren't any i/o errors sent to dmesg when the
-    # test files were sync'ed to the disk
-    check_log = journal_log.seek_realtime(check_time)
-    if check_log and "I/O error" in check_log:
-        print("ERROR: I/O errors found in dmesg")
-        sys.exit(1)
-    else:
-        logging.debug("No I/O errors found in dmesg")
-    print("PASS: WRITING TEST: %s" % target_file)
-    return dd_speed
+        :param random_file: a RandomData object
+        :param partition: the partition to test, e.g. sdb1
+        :param folder: the mount point, folder_to_mount by default
+        :return: a PartitionResult
+        """
+        with mount_usb_storage(
+            partition, folder or self.folder_to_mount, self.mounts
+        ) as folder:
+            plan = None
+            source = random_file
+            if self.config.adaptive:
+                plan = self.plan_test_size(source, partition, folder)
+                if plan.file_size != source.size:
+                    random_file = RandomData(
+                        plan.file_size, source.tfile is None
+                    )
+            try:
+                if self.config.pipelined:
+                    write_results, read_results = self.pipelined_test(
+                        random_file, folder, plan=plan
+                    )
+                else:
+                    # write test
+                    write_results = self.write_test(
+                        random_file, folder, plan=plan
+                    )
+                    # already write some data into the target
+                    # so let's read it to perform the read test
+                    # and validate the writing correctness
+                    read_results = self.read_test(
+                        random_file, folder, repetitions=len(write_results)
+                    )
+            finally:
+                # delete the source file sized for this partition
+                if random_file is not source and random_file.tfile:
+                    os.unlink(random_file.tfile.name)
+        return PartitionResult(partition, write_results, read_results)
 
+    def plan_test_size(self, random_file, partition, folder):
+        """
+        choose the file size and repetitions of a partition from its speed.
 
-@contextlib.contextmanager
-def gen_random_file():
-    """
-    generate a random file which size is RANDOM_FILE_SIZE.
+        A probe file is written to estimate the writing speed. The files
+        are sized so config.repetition_num writes and reads of them take
+        config.target_duration seconds. The number of repetitions is
+        capped by the target duration too, and the files of all the
+        repetitions never use more than config.space_fraction of the free
+        space. Without streamed data the files are not larger than
+        config.file_size, as the source file is kept in /tmp.
 
-    :return: a RandomData object
-    """
-    logging.debug("generating a random file")
-    try:
-        random_file = RandomData(RANDOM_FILE_SIZE)
-        yield random_file
-    finally:
-        logging.info("Remove temporary folders and files.")
-        # delete the mount folder
+        :param random_file: a RandomData object, only its pattern is used
+        :param partition: the partition tested, e.g. sdb1
+        :param folder: the mount point of the partition
+        :return: a TestPlan
+        """
         try:
-            os.rmdir(FOLDER_TO_MOUNT)
-        except OSError:
-            logging.warning(
-                "Failed to remove %s (mount folder not empty)."
-                % FOLDER_TO_MOUNT
+            block_size = parse_size(self.config.block_size)
+            probe_size = parse_size(self.config.probe_size)
+        except ValueError as e:
+            logging.error("invalid adaptive sizing configuration: %s", e)
+            sys.exit(1)
+        statvfs = os.statvfs(folder)
+        space = (
+            statvfs.f_bavail * statvfs.f_frsize * self.config.space_fraction
+        )
+        probe_size = max(block_size, min(probe_size, int(space) // 4))
+        probe_file = os.path.join(folder, random_file.name) + "-probe"
+        try:
+            probe = native_write(
+                RandomData(probe_size, streamed=True),
+                probe_file,
+                block_size,
+                self.config.write_oflag,
+            )
+        except (OSError, ValueError) as e:
+            print("ERROR: {}".format(e))
+            sys.exit(1)
+        finally:
+            if os.path.exists(probe_file):
+                os.remove(probe_file)
+        # assume reading is as fast as writing, it is usually faster
+        unit_seconds = self.config.target_duration / (
+            2 * self.config.repetition_num
+        )
+        file_size = probe.speed * 1e6 * unit_seconds
+        if random_file.tfile is not None:
+            file_size = min(file_size, self.config.file_size)
+        file_size = min(file_size, space / ADAPTIVE_MIN_REPETITIONS)
+        # whole blocks only, so O_DIRECT never needs a partial one
+        file_size = max(block_size, int(file_size) // block_size * block_size)
+        repetitions = min(
+            ADAPTIVE_MAX_REPETITIONS,
+            int(space // file_size),
+            int(
+                self.config.target_duration
+                / (2 * file_size / (probe.speed * 1e6))
+            ),
+        )
+        plan = TestPlan(file_size, max(ADAPTIVE_MIN_REPETITIONS, repetitions))
+        print(
+            "Adaptive sizing of {}: probe writing speed {:.3f} MB/s, "
+            "{:.0f} MiB usable, {:.1f} MiB files, up to {} repetitions".format(
+                partition,
+                probe.speed,
+                space / 1024**2,
+                plan.file_size / 1024**2,
+                plan.repetitions,
             )
-        # delete the random file (source file of a writing test)
-        os.unlink(random_file.tfile.name)
+        )
+        return plan
 
+    def block_size_sweep(self, random_file, partition, block_sizes=None):
+        """
+        run the write and read tests of a partition with several block sizes.
 
-def get_md5sum(file_to_check):
-    """
-    get md5sum of file_to_check.
+        The partition is mounted once for the whole sweep and the same source
+        file is written with every block size.
 
-    :param file_to_check: the absolute path of a file to access its md5sum
-    :return: md5sum as a string
-    """
+        :param random_file: a RandomData object
+        :param partition: the partition to test, e.g. sdb1
+        :param block_sizes: a list of dd style block sizes, e.g. ["4K", "1M"],
+            config.sweep_block_sizes by default
+        :return: a list of (block size, PartitionResult) tuples
+        """
+        try:
+            block_sizes = block_sizes or self.config.sweep_block_sizes
+            sizes = [parse_size(block_size) for block_size in block_sizes]
+        except ValueError as e:
+            logging.error("invalid block size sweep: %s", e)
+            sys.exit(1)
+        table = []
+        with mount_usb_storage(
+            partition, self.folder_to_mount, self.mounts
+        ) as folder:
+            for block_size, size in zip(block_sizes, sizes):
+                print("Block size {}:".format(block_size))
+                if self.config.pipelined:
+                    write_results, read_results = self.pipelined_test(
+                        random_file, folder, size
+                    )
+                else:
+                    write_results = self.write_test(random_file, folder, size)
+                    read_results = self.read_test(random_file, folder, size)
+                table.append(
+                    (
+                        block_size,
+                        PartitionResult(
+                            partition, write_results, read_results
+                        ),
+                    )
+                )
+        print("Throughput of {} by block size:".format(partition))
+        print(
+            "{:>10} {:>12} {:>12}".format(
+                "block size", "write MB/s", "read MB/s"
+            )
+        )
+        for block_size, result in table:
+            print(
+                "{:>10} {:>12.3f} {:>12.3f}".format(
+                    block_size,
+                    average_speed(result.write),
+                    average_speed(result.read),
+                )
+            )
+        return table
+
+    def buffered_test(self, random_file, partition):
+        """
+        write files through the page cache and time how long they take to
+        reach the device.
+
+        The partition is mounted for every file, the write() calls, the
+        fsync() of the file, the syncfs() of the filesystem and the umount
+        are timed separately, the end to end speed includes all of them.
+        Every file is read back and verified after mounting the partition
+        again, so the data comes from the device.
+
+        :param random_file: a RandomData object created to be written
+        :param partition: the partition to test, e.g. sdb1
+        :return: a list of BufferedResult, one per repetition
+        """
+        try:
+            block_size = parse_size(self.config.block_size)
+        except ValueError as e:
+            logging.error("invalid block size: %s", e)
+            sys.exit(1)
+        results = []
+        previous = None
+        for idx in range(self.config.repetition_num + 1):
+            with mount_usb_storage(
+                partition, self.folder_to_mount, self.mounts
+            ) as folder:
+                if previous is not None:
+                    self.read_test_unit(random_file, previous, folder)
+                if idx == self.config.repetition_num:
+                    break
+                previous = "-buffered{}".format(idx)
+                target_file = os.path.join(folder, random_file.name) + previous
+                log_scanner = KernelLogScanner(block_devices(folder))
+                try:
+                    # the removal of the previous file is not timed
+                    sync_filesystem(folder)
+                    result = buffered_write(
+                        random_file, target_file, block_size
+                    )
+                except (OSError, ValueError) as e:
+                    log_scanner.close()
+                    print("ERROR: {}".format(e))
+                    sys.exit(1)
+            metric = self.mounts[-1]
+            if not metric["reused"]:
+                result = result._replace(
+                    umount_seconds=metric["umount_seconds"]
+                )
+            # the writeback may only fail during the umount
+            try:
+                check_io_errors(log_scanner)
+            finally:
+                log_scanner.close()
+            print(
+                "PASS: BUFFERED WRITING TEST: {}: {}".format(
+                    target_file, format_buffered_result(result)
+                )
+            )
+            results.append(result)
+        write_speeds = [buffered_speed(result, False) for result in results]
+        speeds = [buffered_speed(result) for result in results]
+        print(
+            "Average buffered writing speed is: {:.3f} MB/s, {:.3f} MB/s "
+            "end to end ({}x{} MB files were written)".format(
+                statistics.mean(write_speeds),
+                statistics.mean(speeds),
+                len(results),
+                random_file.size / (1024 * 1024),
+            )
+        )
+        if results[0].umount_seconds is None:
+            logging.info("%s was already mounted, umount not timed", partition)
+        return results
+
+    def sustained_write_test(self, random_file, partition):
+        """
+        write a partition for a long time and report its sustained speed.
+
+        A single file is written until config.sustained_duration seconds
+        elapsed or config.sustained_space_fraction of the free space of the
+        partition is used. The throughput is sampled every config.sample_size
+        bytes, a sharp and lasting drop of the throughput is reported as the
+        size of the write cache.
+
+        :param random_file: a RandomData object, only its pattern is used
+        :param partition: the partition to test, e.g. sdb1
+        :return: a list of Sample
+        """
+        try:
+            block_size = parse_size(self.config.block_size)
+            sample_size = parse_size(self.config.sample_size)
+        except ValueError as e:
+            logging.error("invalid sustained write configuration: %s", e)
+            sys.exit(1)
+        with mount_usb_storage(
+            partition, self.folder_to_mount, self.mounts
+        ) as folder:
+            statvfs = os.statvfs(folder)
+            max_bytes = int(
+                statvfs.f_bavail
+                * statvfs.f_frsize
+                * self.config.sustained_space_fraction
+            )
+            # the data is not kept in a file, so it can be as large as needed
+            data = RandomData(max_bytes, streamed=True)
+            target_file = os.path.join(folder, random_file.name) + "-sustained"
+            log_scanner = KernelLogScanner(block_devices(folder))
+            print(
+                "Sustained write on {}: up to {:.0f} MiB or {:.0f} s".format(
+                    partition,
+                    max_bytes / 1024**2,
+                    self.config.sustained_duration,
+                )
+            )
+            try:
+                samples = sustained_write(
+                    data,
+                    target_file,
+                    block_size,
+                    self.config.write_oflag,
+                    sample_size,
+                    self.config.sustained_duration,
+                )
+                check_io_errors(log_scanner)
+            except (OSError, ValueError) as e:
+                print("ERROR: {}".format(e))
+                sys.exit(1)
+            finally:
+                log_scanner.close()
+                if os.path.exists(target_file):
+                    os.remove(target_file)
+        for sample in samples:
+            logging.debug(
+                "%.3f s %d bytes %.3f MB/s", sample.seconds, *sample[1:]
+            )
+        if not samples:
+            print("ERROR: not enough free space for a single sample")
+            sys.exit(1)
+        boundary, burst_speed, steady_speed = find_cache_boundary(samples)
+        print(
+            "Wrote {:.0f} MiB in {:.1f} s".format(
+                samples[-1].bytes / 1024**2, samples[-1].seconds
+            )
+        )
+        if boundary is None:
+            print(
+                "No cache boundary found, sustained writing speed is: "
+                "{:.3f} MB/s".format(steady_speed)
+            )
+        else:
+            print(
+                "Cache boundary after {:.0f} MiB: writing speed dropped from "
+                "{:.3f} MB/s to a steady {:.3f} MB/s".format(
+                    samples[boundary - 1].bytes / 1024**2,
+                    burst_speed,
+                    steady_speed,
+                )
+            )
+        return samples
+
+    def random_io_test(self, random_file, partition):
+        """
+        run the random read and write tests on a partition.
+
+        The source file is copied to the partition first, the random
+        operations then read and overwrite blocks inside it, so reads hit
+        allocated blocks and writes never extend the file. Every queue depth
+        of config.queue_depths is tested with config.random_io_ops reads and
+        as many writes.
+
+        :param random_file: a RandomData object
+        :param partition: the partition to test, e.g. sdb1
+        :return: a list of (queue depth, operation, RandomIOResult) tuples
+        """
+        try:
+            io_size = parse_size(self.config.random_io_size)
+            queue_depths = [int(depth) for depth in self.config.queue_depths]
+            if (
+                self.config.random_io_ops < 1
+                or min(queue_depths, default=0) < 1
+            ):
+                raise ValueError(
+                    "{} operations at queue depths {}".format(
+                        self.config.random_io_ops, self.config.queue_depths
+                    )
+                )
+        except ValueError as e:
+            logging.error("invalid random I/O configuration: %s", e)
+            sys.exit(1)
+        results = []
+        with mount_usb_storage(
+            partition, self.folder_to_mount, self.mounts
+        ) as folder:
+            target_file = os.path.join(folder, random_file.name) + "-random-io"
+            try:
+                native_write(
+                    random_file,
+                    target_file,
+                    parse_size(self.config.block_size),
+                    self.config.write_oflag,
+                )
+                for queue_depth, operation in itertools.product(
+                    queue_depths, ("read", "write")
+                ):
+                    result = random_io(
+                        target_file,
+                        operation,
+                        io_size,
+                        queue_depth,
+                        self.config.random_io_ops,
+                        self.config.random_io_oflag,
+                    )
+                    results.append((queue_depth, operation, result))
+                    print(
+                        "Random {} {}, queue depth {}: {:.1f} IOPS "
+                        "({:.3f} MB/s), latency (ms) {}".format(
+                            self.config.random_io_size,
+                            operation,
+                            queue_depth,
+                            result.iops,
+                            result.iops * io_size / 1e6,
+                            format_latencies(result.latencies),
+                        )
+                    )
+            except (OSError, ValueError) as e:
+                print("ERROR: {}".format(e))
+                sys.exit(1)
+            finally:
+                if os.path.exists(target_file):
+                    os.remove(target_file)
+        return results
+
+    def commit_latency_test(self, partition):
+        """
+        time small synchronous writes appended to a file, as the commits of
+        a database journal.
+
+        :param partition: the partition to test, e.g. sdb1
+        :return: a CommitResult
+        """
+        try:
+            sizes = [parse_size(size) for size in self.config.commit_sizes]
+            if self.config.commits < 1 or not sizes:
+                raise ValueError(
+                    "{} commits of {}".format(
+                        self.config.commits, self.config.commit_sizes
+                    )
+                )
+            if self.config.commit_sync not in ("dsync", "fdatasync"):
+                raise ValueError(
+                    "unknown commit sync: {}".format(self.config.commit_sync)
+                )
+        except ValueError as e:
+            logging.error("invalid commit latency configuration: %s", e)
+            sys.exit(1)
+        with mount_usb_storage(
+            partition, self.folder_to_mount, self.mounts
+        ) as folder:
+            target_file = os.path.join(
+                folder, "commits-{}".format(os.urandom(4).hex())
+            )
+            log_scanner = KernelLogScanner(block_devices(folder))
+            try:
+                result = commit_latency(
+                    target_file,
+                    sizes,
+                    self.config.commits,
+                    self.config.commit_sync,
+                )
+                check_io_errors(log_scanner)
+            except (OSError, ValueError) as e:
+                print("ERROR: {}".format(e))
+                sys.exit(1)
+            finally:
+                log_scanner.close()
+                if os.path.exists(target_file):
+                    os.remove(target_file)
+        latencies = array.array("d", sorted(result.latencies))
+        print(
+            "{} {} commits of {} on {}: {:.1f} commits/s, "
+            "latency (ms) {}".format(
+                result.commits,
+                self.config.commit_sync,
+                "/".join(self.config.commit_sizes),
+                partition,
+                result.commits / result.seconds if result.seconds else 0.0,
+                format_latencies(latencies),
+            )
+        )
+        for bound, count in latency_histogram(latencies):
+            print(
+                "  <= {:9.3f} ms {:7d} {}".format(
+                    bound * 1e3,
+                    count,
+                    "#" * math.ceil(count / result.commits * 50),
+                )
+            )
+        return result
+
+    def scaling_test(self, random_file, partition):
+        """
+        run the write and read tests with several concurrent streams.
+
+        For every count of config.stream_counts, as many threads write a
+        file each at the same time on the partition, then read and verify
+        them at the same time, with the write and read test units.
+
+        :param random_file: a RandomData object
+        :param partition: the partition to test, e.g. sdb1
+        :return: a list of ScalingResult
+        """
+        try:
+            stream_counts = [int(count) for count in self.config.stream_counts]
+            if min(stream_counts, default=0) < 1:
+                raise ValueError(
+                    "{} streams".format(" ".join(self.config.stream_counts))
+                )
+        except ValueError as e:
+            logging.error("invalid stream counts: %s", e)
+            sys.exit(1)
+        results = []
+        with mount_usb_storage(
+            partition, self.folder_to_mount, self.mounts
+        ) as folder:
+            for streams in stream_counts:
+                labels = [
+                    "-{}streams-{}".format(streams, idx)
+                    for idx in range(streams)
+                ]
+                log_scanner = KernelLogScanner(block_devices(folder))
+                try:
+                    with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=streams
+                    ) as executor:
+                        # map() re-raises the SystemExit of a failed unit
+                        write_results = list(
+                            executor.map(
+                                lambda label: self.write_test_unit(
+                                    random_file,
+                                    label,
+                                    folder,
+                                    log_scanner=log_scanner,
+                                ),
+                                labels,
+                            )
+                        )
+                finally:
+                    log_scanner.close()
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=streams
+                ) as executor:
+                    read_results = list(
+                        executor.map(
+                            lambda label: self.read_test_unit(
+                                random_file, label, folder
+                            ),
+                            labels,
+                        )
+                    )
+                results.append(
+                    ScalingResult(streams, write_results, read_results)
+                )
+        print("Throughput of {} by number of streams:".format(partition))
+        print(
+            "{:>7} {:>17} {:>15} {:>17} {:>15}".format(
+                "streams",
+                "write MB/s/stream",
+                "aggregate MB/s",
+                "read MB/s/stream",
+                "aggregate MB/s",
+            )
+        )
+        for result in results:
+            print(
+                "{:>7} {:>17.3f} {:>15.3f} {:>17.3f} {:>15.3f}".format(
+                    result.streams,
+                    average_speed(result.write),
+                    aggregate_speed(result.write),
+                    average_speed(result.read),
+                    aggregate_speed(result.read),
+                )
+            )
+        return results
+
+    def metadata_test(self, random_file, partition):
+        """
+        run the small file metadata workload on a partition.
+
+        config.metadata_files files of config.metadata_file_size are
+        created in a tree of directories with at most
+        config.metadata_fanout entries each, as extracting an archive would, by
+        config.metadata_threads threads.
+
+        :param random_file: a RandomData object, the first bytes of its
+            data are the content of every file
+        :param partition: the partition to test, e.g. sdb1
+        :return: a list of PhaseResult
+        """
+        try:
+            file_size = parse_size(self.config.metadata_file_size)
+            if self.config.metadata_fanout < 2:
+                raise ValueError(
+                    "fanout {} is below 2".format(self.config.metadata_fanout)
+                )
+        except ValueError as e:
+            logging.error("invalid metadata configuration: %s", e)
+            sys.exit(1)
+        payload = bytearray(file_size)
+        del payload[random_file.readinto(payload, 0) :]
+        with mount_usb_storage(
+            partition, self.folder_to_mount, self.mounts
+        ) as folder:
+            tree = os.path.join(folder, random_file.name) + "-metadata"
+            log_scanner = KernelLogScanner(block_devices(folder))
+            try:
+                os.mkdir(tree)
+                results = metadata_workload(
+                    tree,
+                    bytes(payload),
+                    self.config.metadata_files,
+                    self.config.metadata_fanout,
+                    max(1, self.config.metadata_threads),
+                )
+                check_io_errors(log_scanner)
+            except (OSError, ValueError) as e:
+                print("ERROR: {}".format(e))
+                sys.exit(1)
+            finally:
+                log_scanner.close()
+                shutil.rmtree(tree, ignore_errors=True)
+        for result in results:
+            print(
+                "Metadata {}: {} files in {:.3f} s, {:.1f} ops/s".format(
+                    *result
+                )
+            )
+        return results
+
+    def parallel_test(self, random_file, partitions):
+        """
+        run partition_test on all partitions at the same time.
+
+        Every partition gets its own mount point and worker thread. A failing
+        partition does not stop the others, the script exits with an error
+        once all of them are done.
+
+        :param random_file: a RandomData object
+        :param partitions: a list of partitions, e.g. ["sdb1", "sdc1"]
+        :return: a list of PartitionResult
+        """
+        folders = {
+            partition: tempfile.mkdtemp(dir="/mnt/", prefix=partition + "-")
+            for partition in partitions
+        }
+
+        def worker(partition):
+            try:
+                return self.partition_test(
+                    random_file, partition, folders[partition]
+                )
+            except SystemExit:
+                logging.error("FAIL: %s failed the read/write test", partition)
+                return PartitionResult(partition, None, None)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(partitions)
+            ) as executor:
+                results = list(executor.map(worker, partitions))
+        finally:
+            for folder in folders.values():
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    logging.warning(
+                        "Failed to remove %s (mount folder not empty).", folder
+                    )
+        print("Per-device results of the concurrent test:")
+        for result in results:
+            if result.write is None:
+                print("  {}: FAIL".format(result.partition))
+            else:
+                print(
+                    "  {}: write {:.3f} MB/s, read {:.3f} MB/s".format(
+                        result.partition,
+                        average_speed(result.write),
+                        average_speed(result.read),
+                    )
+                )
+        if any(result.write is None for result in results):
+            sys.exit(1)
+        return results
+
+    def read_test(
+        self, random_file, folder=None, block_size=None, repetitions=None
+    ):
+        """
+        perform the read test.
+
+        :param random_file: a RandomData object
+        :param folder: the mount point, folder_to_mount by default
+        :param block_size: the read size in bytes, config.block_size by
+            default
+        :param repetitions: the number of files written by the write test,
+            config.repetition_num by default
+        :return: a list of IOResult, one per repetition
+        """
+        logging.debug("===================")
+        logging.debug("reading test begins")
+        logging.debug("===================")
+        # with O_DIRECT the verification reads the device again, it would
+        # compete with the next timed read
+        overlap = not parse_oflag(self.config.read_iflag) & os.O_DIRECT
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, self.config.verify_workers)
+        ) as executor:
+            futures = []
+            # the timed reads run one after the other, so they do not
+            # compete for the device, only the verification is parallel
+            for idx in range(repetitions or self.config.repetition_num):
+                path, result = self.timed_read_unit(
+                    random_file, str(idx), folder, block_size
+                )
+                futures.append(
+                    executor.submit(
+                        self.verify_read_unit,
+                        random_file,
+                        path,
+                        result,
+                        block_size,
+                    )
+                )
+                if not overlap:
+                    futures[-1].result()
+            # result() re-raises the SystemExit of a failed unit here
+            read_test_list = [future.result() for future in futures]
+        self.print_summary(read_test_list, "reading", "read")
+        print("PASS: all reading tests passed.")
+        return read_test_list
+
+    def read_test_unit(
+        self, random_source_file, idx="", folder=None, block_size=None
+    ):
+        """
+        perform the read test.
+
+        :param random_source_file: a RandomData object
+        :param idx: a idx to label the files to be compared with the source
+              file. It is an int string, "1", "2", "3", ......etc.
+        :param folder: the mount point, folder_to_mount by default
+        :param block_size: the read size in bytes, config.block_size by
+            default
+        :return: an IOResult of the timed read, its speed is a float in MB/s
+        """
+        path, result = self.timed_read_unit(
+            random_source_file, idx, folder, block_size
+        )
+        return self.verify_read_unit(
+            random_source_file, path, result, block_size
+        )
+
+    def timed_read_unit(
+        self, random_source_file, idx="", folder=None, block_size=None
+    ):
+        """
+        measure the read speed of a file written by the write test.
+
+        :param random_source_file: a RandomData object
+        :param idx: the idx the file was written with
+        :param folder: the mount point, folder_to_mount by default
+        :param block_size: the read size in bytes, config.block_size by
+            default
+        :return: a tuple of the path of the file and of the IOResult of
+            the timed read
+        """
+        # access the temporary file
+        path_random_file = (
+            os.path.join(
+                folder or self.folder_to_mount,
+                random_source_file.name,
+            )
+            + idx
+        )
+        block_size = block_size or parse_size(self.config.block_size)
+        try:
+            sampler = IoStatSampler(
+                block_devices(path_random_file), self.config.stat_interval
+            )
+            cpu_meter = CpuMeter()
+            # measure the read speed of the device, the file was just written
+            # so it would be served from the page cache otherwise
+            with sampler, cpu_meter:
+                result = timed_read(
+                    path_random_file, block_size, self.config.read_iflag
+                )
+            result = result._replace(
+                device=sampler.stats(), cpu_usage=cpu_meter.stats()
+            )
+        except OSError as e:
+            logging.warning(
+                "FAIL: READING TEST: %s could not be read: %s",
+                path_random_file,
+                e,
+            )
+            sys.exit(1)
+        logging.debug(
+            "read %d bytes in %.6f s (%.3f MB/s) from %s",
+            *result[:3],
+            path_random_file
+        )
+        print_device_stats(result.device)
+        return path_random_file, result
+
+    def verify_read_unit(
+        self, random_source_file, path_random_file, result, block_size=None
+    ):
+        """
+        compare a file read by timed_read_unit() with the source data and
+        remove it.
+
+        :param random_source_file: a RandomData object
+        :param path_random_file: the path of the file
+        :param result: the IOResult of the timed read of the file
+        :param block_size: the read size in bytes, config.block_size by
+            default
+        :return: result
+        """
+        block_size = block_size or parse_size(self.config.block_size)
+        chunk_digest = None
+        if self.config.verify != "md5":
+            # checked by Config.mode() before anything is written
+            chunk_digest = CHUNK_DIGESTS[self.config.verify]
+            chunk_size = parse_size(self.config.verify_chunk_size)
+        try:
+            if chunk_digest is not None:
+                mismatches = verify_chunks(
+                    path_random_file,
+                    random_source_file,
+                    chunk_size,
+                    self.config.verify,
+                    self.config.verify_stop_early,
+                )
+            elif random_source_file.tfile is None:
+                # no source file to hash, compare with the regenerated data
+                mismatch = compare_with_source(
+                    path_random_file, random_source_file, block_size
+                )
+            else:
+                # get the md5sum of the temp random files to compare
+                tfile_md5sum = hash_file(path_random_file)
+        except OSError as e:
+            logging.warning(
+                "FAIL: READING TEST: %s could not be read: %s",
+                path_random_file,
+                e,
+            )
+            sys.exit(1)
+        if chunk_digest is not None:
+            os.remove(path_random_file)
+            if mismatches:
+                logging.warning(
+                    "FAIL: READING TEST: %s differs from the source data "
+                    "in bytes %s.",
+                    path_random_file,
+                    format_ranges(mismatches),
+                )
+                sys.exit(1)
+            print(
+                "PASS: READING TEST: %s passes %s comparison (%.3f MB/s)."
+                % (path_random_file, self.config.verify, result.speed)
+            )
+            return result
+        if random_source_file.tfile is None:
+            os.remove(path_random_file)
+            if mismatch is not None:
+                logging.warning(
+                    "FAIL: READING TEST: %s differs from the source data "
+                    "at byte %d.",
+                    path_random_file,
+                    mismatch,
+                )
+                sys.exit(1)
+            print(
+                "PASS: READING TEST: %s passes data comparison (%.3f MB/s)."
+                % (path_random_file, result.speed)
+            )
+            return result
+        # the md5sum of the source random file is computed once on creation
+        source_md5sum = random_source_file.md5sum
+        logging.debug("%s %s (verified)" % (tfile_md5sum, path_random_file))
+        logging.debug(
+            "%s %s (source)", source_md5sum, random_source_file.tfile.name
+        )
+        # Clean the target file
+        os.remove(path_random_file)
+        # verify the md5sum
+        if tfile_md5sum == source_md5sum:
+            print(
+                "PASS: READING TEST: %s passes md5sum comparison (%.3f MB/s)."
+                % (path_random_file, result.speed)
+            )
+            return result
+        else:
+            # failed in the reading test
+            # tell plainbox the failure code
+            logging.warning(
+                "FAIL: READING TEST: %s failed in md5sum comparison."
+                % path_random_file
+            )
+            sys.exit(1)
+
+    def write_test(self, random_file, folder=None, block_size=None, plan=None):
+        """
+        perform a writing test.
+
+        :param random_file: a RandomData object created to be written
+        :param folder: the mount point, folder_to_mount by default
+        :param block_size: the write size in bytes, config.block_size by
+            default
+        :param plan: a TestPlan, the writes stop once the speed is known
+            precisely enough, config.repetition_num writes are done if None
+        :return: a list of IOResult, one per repetition
+        """
+        logging.debug("===================")
+        logging.debug("writing test begins")
+        logging.debug("===================")
+        write_test_list = []
+        log_scanner = KernelLogScanner(
+            block_devices(folder or self.folder_to_mount)
+        )
+        try:
+            for idx in range(
+                plan.repetitions if plan else self.config.repetition_num
+            ):
+                write_test_list.append(
+                    self.write_test_unit(
+                        random_file, str(idx), folder, block_size, log_scanner
+                    )
+                )
+                if plan and self.precise_enough(write_test_list):
+                    break
+        finally:
+            log_scanner.close()
+        self.print_summary(write_test_list, "writing", "written")
+        return write_test_list
+
+    def pipelined_test(self, random_file, folder, block_size=None, plan=None):
+        """
+        perform the writing and reading tests as a pipeline.
+
+        Every file is read and verified by a single reading thread while
+        the next one is written, instead of verifying all of them once
+        they are all written. The reads still drop the page cache of the
+        file first and never overlap each other, but they compete with the
+        writes for the device, so the speeds are less accurate than the
+        ones of the serial tests.
+
+        :param random_file: a RandomData object created to be written
+        :param folder: the mount point
+        :param block_size: the write and read size in bytes,
+            config.block_size by default
+        :param plan: a TestPlan, the writes stop once the speed is known
+            precisely enough, config.repetition_num writes are done if None
+        :return: a tuple of two lists of IOResult, the writes and the reads
+        """
+        logging.debug("=============================")
+        logging.debug("pipelined write/verify begins")
+        logging.debug("=============================")
+
+        def timed(unit, *args):
+            start = time.perf_counter()
+            result = unit(*args)
+            return result, time.perf_counter() - start
+
+        write_test_list = []
+        write_seconds = 0.0
+        futures = []
+        log_scanner = KernelLogScanner(block_devices(folder))
+        start = time.perf_counter()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=1
+            ) as executor:
+                for idx in range(
+                    plan.repetitions if plan else self.config.repetition_num
+                ):
+                    result, seconds = timed(
+                        self.write_test_unit,
+                        random_file,
+                        str(idx),
+                        folder,
+                        block_size,
+                        log_scanner,
+                    )
+                    write_test_list.append(result)
+                    write_seconds += seconds
+                    futures.append(
+                        executor.submit(
+                            timed,
+                            self.read_test_unit,
+                            random_file,
+                            str(idx),
+                            folder,
+                            block_size,
+                        )
+                    )
+                    if plan and self.precise_enough(write_test_list):
+                        break
+                # result() re-raises the SystemExit of a failed unit here
+                reads = [future.result() for future in futures]
+        finally:
+            log_scanner.close()
+        elapsed = time.perf_counter() - start
+        read_test_list = [result for result, _ in reads]
+        read_seconds = sum(seconds for _, seconds in reads)
+        self.print_summary(write_test_list, "writing", "written")
+        self.print_summary(read_test_list, "reading", "read")
+        overlap = write_seconds + read_seconds - elapsed
+        print(
+            "Pipelined write/verify took {:.3f} s instead of {:.3f} s, "
+            "{:.1f}% of the verification overlapped the writes".format(
+                elapsed,
+                write_seconds + read_seconds,
+                overlap / read_seconds * 100 if read_seconds else 0.0,
+            )
+        )
+        print("PASS: all reading tests passed.")
+        return write_test_list, read_test_list
+
+    def print_summary(self, results, operation, done):
+        """
+        print the average and the spread of the speeds of a test.
+
+        :param results: a list of IOResult, one per repetition
+        :param operation: the name of the test, "writing" or "reading"
+        :param done: the past participle of the operation, e.g. "written"
+        """
+        file_size_in_mb = results[0].bytes / (1024 * 1024)
+        print(
+            "Average {} speed is: {:.3f} MB/s "
+            "({}x{} MB files were {})".format(
+                operation,
+                average_speed(results),
+                len(results),
+                file_size_in_mb,
+                done,
+            )
+        )
+        print(
+            "{} speed min/median/max/stddev: "
+            "{min:.3f}/{median:.3f}/{max:.3f}/{stddev:.3f} MB/s".format(
+                operation.capitalize(), **io_statistics(results)
+            )
+        )
+        cpu = cpu_statistics(results)
+        if cpu is not None:
+            print(
+                "{} CPU cost is: {:.3f} CPU s/GB (all CPUs: user {:.1f}%, "
+                "system {:.1f}%, iowait {:.1f}%, irq {:.1f}%, "
+                "softirq {:.1f}%)".format(
+                    operation.capitalize(),
+                    cpu["cpu_seconds_per_gb"],
+                    cpu["user"],
+                    cpu["system"],
+                    cpu["iowait"],
+                    cpu["irq"],
+                    cpu["softirq"],
+                )
+            )
+        if all(result.cpu_seconds is not None for result in results):
+            cpu_seconds = statistics.mean(
+                result.cpu_seconds for result in results
+            )
+            seconds = statistics.mean(result.seconds for result in results)
+            print(
+                "{} CPU time is: {:.3f} s per file "
+                "({:.1f}% of the elapsed time)".format(
+                    operation.capitalize(),
+                    cpu_seconds,
+                    cpu_seconds / seconds * 100 if seconds else 0.0,
+                )
+            )
+
+    def precise_enough(self, results):
+        """
+        :param results: a list of IOResult
+        :return: True if the 95% confidence interval of the mean speed is
+            within config.confidence of it, after a few repetitions
+        """
+        if len(results) < ADAPTIVE_MIN_REPETITIONS:
+            return False
+        interval = relative_confidence_interval(
+            [result.speed for result in results]
+        )
+        logging.debug(
+            "95%% confidence interval after %d repetitions: +/-%.1f%%",
+            len(results),
+            interval * 100,
+        )
+        return interval <= self.config.confidence
+
+    def write_test_unit(
+        self,
+        random_file,
+        idx="",
+        folder=None,
+        block_size=None,
+        log_scanner=None,
+    ):
+        """
+        perform the writing test.
+
+        :param random_file: a RandomData object created to be written
+        :param idx: a idx to label the file written on the target
+        :param folder: the mount point, folder_to_mount by default
+        :param block_size: the write size in bytes, config.block_size by
+            default
+        :param log_scanner: a KernelLogScanner of the mount point, a new one
+            is used for this unit only if not given
+        :return: an IOResult, its speed is a float in MB/s
+        """
+        folder = folder or self.folder_to_mount
+        if log_scanner is None:
+            log_scanner = KernelLogScanner(block_devices(folder))
+            try:
+                return self.write_test_unit(
+                    random_file, idx, folder, block_size, log_scanner
+                )
+            finally:
+                log_scanner.close()
+        target_file = os.path.join(folder, random_file.name) + idx
+        try:
+            write_engine = WRITE_ENGINES[self.config.write_engine]
+        except KeyError:
+            logging.error("unknown write engine: %s", self.config.write_engine)
+            sys.exit(1)
+        sampler = IoStatSampler(
+            block_devices(folder), self.config.stat_interval
+        )
+        cpu_meter = CpuMeter()
+        try:
+            with sampler, cpu_meter:
+                result = write_engine(
+                    random_file,
+                    target_file,
+                    block_size or parse_size(self.config.block_size),
+                    self.config.write_oflag,
+                )
+        except (OSError, ValueError) as e:
+            print("ERROR: {}".format(e))
+            sys.exit(1)
+        result = result._replace(
+            device=sampler.stats(), cpu_usage=cpu_meter.stats()
+        )
+        logging.debug(
+            "%s engine wrote %d bytes in %.6f s (%.3f MB/s), "
+            "%.6f s of CPU time",
+            self.config.write_engine,
+            *result[:3],
+            result.cpu_seconds
+        )
+        # lp:1852510 - check there weren't any i/o errors sent to dmesg when
+        # the test files were sync'ed to the disk
+        check_io_errors(log_scanner)
+        print_device_stats(result.device)
+        print(
+            "PASS: WRITING TEST: %s (%.3f MB/s)" % (target_file, result.speed)
+        )
+        return result
+
+
+def peak_rss():
+    """
+    :return: a dict of the maximum resident set sizes in KiB of this
+        process and of its largest ended child
+    """
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def save_results(report, session_share):
+    """
+    save the results of the run as JSON in the session share.
+
+    :param report: a JSON serializable dict
+    :param session_share: the folder of the results file
+    """
+    results_path = os.path.join(session_share, RESULTS_FILE)
+    with open(results_path, "w") as results_file:
+        json.dump(report, results_file, indent=2)
+    logging.info("results saved to %s", results_path)
+
+
+def load_baseline(session_share):
+    """
+    load the speeds of the previous runs from the session share.
+
+    :param session_share: the folder of the baseline file
+    :return: a dict of the runs of every device, empty if there is none
+    """
+    baseline_path = os.path.join(session_share, BASELINE_FILE)
+    try:
+        with open(baseline_path) as baseline_file:
+            return json.load(baseline_file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning("ignoring unreadable %s: %s", baseline_path, e)
+        return {}
+
+
+def save_baseline(store, session_share):
+    """
+    save the speeds of the runs in the session share.
+
+    The file is replaced at once, so an interrupted run does not lose the
+    baseline of the previous ones.
+
+    :param store: a dict of the runs of every device
+    :param session_share: the folder of the baseline file
+    """
+    baseline_path = os.path.join(session_share, BASELINE_FILE)
+    with open(baseline_path + ".tmp", "w") as baseline_file:
+        json.dump(store, baseline_file, indent=2)
+    os.replace(baseline_path + ".tmp", baseline_path)
+
+
+def usb_device_identity(partition):
+    """
+    identify the USB device a partition is on.
+
+    :param partition: a partition name, e.g. sdb1
+    :return: a dict of the vendor and product IDs and of the serial number
+        of the device, the serial is empty if the device has none, or None
+        if the partition is not on a USB device
+    """
+    path = usb_device_path(partition)
+    if path is None:
+        return None
+    return {
+        key: read_sysfs_attribute(path, attribute)
+        for key, attribute in (
+            ("vendor", "idVendor"),
+            ("product", "idProduct"),
+            ("serial", "serial"),
+        )
+    }
+
+
+def usb_link(partition):
+    """
+    get the speed of the USB link of the device a partition is on.
+
+    :param partition: a partition name, e.g. sdb1
+    :return: a dict of the negotiated speed, of the USB version of the
+        device descriptor and the highest speed the device supports, of the
+        speed of the hub the device is plugged in and of the highest speed
+        of the root hubs of its host controller, all speeds in Mbit/s, or
+        None if the partition is not on a USB device
+    """
+    path = usb_device_path(partition)
+    if path is None:
+        return None
+    version = read_sysfs_attribute(path, "version")
+    try:
+        speed = float(read_sysfs_attribute(path, "speed"))
+        major = int(float(version))
+    except ValueError:
+        logging.info("no USB speed or version in %s", path)
+        return None
+    hub = os.path.dirname(path)
+    try:
+        hub_speed = float(read_sysfs_attribute(hub, "speed"))
+    except ValueError:
+        hub_speed = speed
+    # the bcdUSB of a SuperSpeed device enumerated at high speed is 2.10,
+    # its BOS descriptor still tells what it supports
+    descriptor_speed = max(
+        usb_capability_speed(path) or 0, USB_VERSION_SPEEDS.get(major, speed)
+    )
+    return {
+        "device": os.path.basename(path),
+        "speed": speed,
+        "version": version,
+        "descriptor_speed": descriptor_speed,
+        "hub_speed": hub_speed,
+        "controller_speed": usb_controller_speed(path, speed),
+    }
+
+
+def usb_capability_speed(path):
+    """
+    :param path: the sysfs path of a USB device
+    :return: the highest speed in Mbit/s of the SuperSpeed capabilities in
+        the BOS descriptor of the device, 0 if it has none, or None if the
+        kernel does not expose the BOS descriptor in sysfs
+    """
+    try:
+        with open(os.path.join(path, "bos_descriptors"), "rb") as f:
+            bos = f.read()
+    except OSError:
+        return None
+    speed = 0
+    # the device capability descriptors follow the BOS header, each starts
+    # with its length, its type (0x10) and its capability type
+    offset = bos[0] if bos else 0
+    while offset + 3 <= len(bos) and bos[offset] >= 3:
+        length, descriptor_type, capability = bos[offset : offset + 3]
+        if descriptor_type == 0x10:
+            speed = max(speed, USB_CAPABILITY_SPEEDS.get(capability, 0))
+        offset += length
+    return speed
+
+
+def usb_controller_speed(path, speed):
+    """
+    :param path: the sysfs path of a USB device
+    :param speed: the speed in Mbit/s to return if there is no root hub
+    :return: the highest speed in Mbit/s of the root hubs of the host
+        controller of the device, an xHCI controller has a high speed and a
+        SuperSpeed root hub, e.g. usb1 and usb2
+    """
+    nodes = path.split(os.sep)
+    speeds = [speed]
+    for index, node in enumerate(nodes):
+        # usbN is the root hub, its parent is the host controller
+        if re.fullmatch(r"usb\d+", node):
+            controller = os.sep.join(nodes[:index])
+            for hub in os.listdir(controller):
+                if re.fullmatch(r"usb\d+", hub):
+                    try:
+                        speeds.append(
+                            float(
+                                read_sysfs_attribute(
+                                    os.path.join(controller, hub), "speed"
+                                )
+                            )
+                        )
+                    except ValueError:
+                        pass
+            break
+    return max(speeds)
+
+
+def usb_device_path(partition):
+    """
+    :param partition: a partition name, e.g. sdb1
+    :return: the sysfs path of the USB device the partition is on, e.g.
+        /sys/devices/pci0000:00/0000:00:14.0/usb2/2-1, or None if the
+        partition is not on a USB device
+    """
+    path = os.path.realpath(os.path.join("/sys/class/block", partition))
+    while path != os.sep:
+        if os.path.exists(os.path.join(path, "idVendor")):
+            return path
+        path = os.path.dirname(path)
+    return None
+
+
+def read_sysfs_attribute(path, attribute):
+    """
+    :param path: the sysfs path of a device
+    :param attribute: the name of an attribute of the device
+    :return: the value of the attribute stripped, empty if there is none
+    """
+    try:
+        with open(os.path.join(path, attribute)) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def relative_confidence_interval(values):
+    """
+    :param values: a list of samples of a normally distributed value
+    :return: the half width of the 95% confidence interval of their mean,
+        relative to the mean, inf with less than 2 values
+    """
+    if len(values) < 2 or not statistics.mean(values):
+        return math.inf
+    t = T_95[len(values) - 2] if len(values) - 2 < len(T_95) else 1.96
+    return (
+        t
+        * statistics.stdev(values)
+        / math.sqrt(len(values))
+        / statistics.mean(values)
+    )
+
+
+def io_statistics(results):
+    """
+    :param results: a non-empty list of IOResult
+    :return: a dict of the min, max, mean, median and stddev of the speeds
+    """
+    speeds = [result.speed for result in results]
+    return {
+        "min": min(speeds),
+        "max": max(speeds),
+        "mean": statistics.mean(speeds),
+        "median": statistics.median(speeds),
+        "stddev": statistics.stdev(speeds) if len(speeds) > 1 else 0.0,
+    }
+
+
+def cpu_statistics(results):
+    """
+    :param results: a non-empty list of IOResult
+    :return: a dict of the CPU seconds of the units per GB (10^9 bytes)
+        transferred and of the shares of the CPU time of the system in
+        percent, None if the CPU usage was not measured
+    """
+    usages = [result.cpu_usage for result in results]
+    if None in usages:
+        return None
+    unit_user = sum(usage.unit_user for usage in usages)
+    unit_system = sum(usage.unit_system for usage in usages)
+    # the CPU times of the system during units running at the same time
+    # are the same, only the ones of units that do not overlap add up
+    system = dict.fromkeys(SYSTEM_CPU_FIELDS, 0.0)
+    end = -math.inf
+    for usage in sorted(usages, key=lambda usage: usage.start):
+        if usage.start < end:
+            continue
+        end = usage.end
+        for field in SYSTEM_CPU_FIELDS:
+            system[field] += getattr(usage, field)
+    system_seconds = sum(system.values())
+    shares = {
+        field: seconds / system_seconds * 100 if system_seconds else 0.0
+        for field, seconds in system.items()
+    }
+    gigabytes = sum(result.bytes for result in results) / 1e9
+    return dict(
+        shares,
+        cpu_seconds_per_gb=(
+            (unit_user + unit_system) / gigabytes if gigabytes else 0.0
+        ),
+        unit_user=unit_user,
+        unit_system=unit_system,
+    )
+
+
+def partition_report(result):
+    """
+    :param result: a PartitionResult
+    :return: a dict with the units and the summary of both directions
+    """
+    report = {"partition": result.partition}
+    for direction in PartitionResult._fields[1:]:
+        results = getattr(result, direction)
+        report[direction] = {
+            "units": [unit_report(unit) for unit in results],
+            "summary": io_statistics(results),
+            "cpu": cpu_statistics(results),
+        }
+    return report
+
+
+def unit_report(result):
+    """
+    :param result: an IOResult
+    :return: a dict of the result and of the statistics of its devices
+    """
+    report = result._asdict()
+    if result.device is not None:
+        report["device"] = {
+            device: stats._asdict() for device, stats in result.device.items()
+        }
+    if result.cpu_usage is not None:
+        report["cpu_usage"] = result.cpu_usage._asdict()
+    return report
+
+
+def sweep_report(partition, table):
+    """
+    :param partition: the partition tested, e.g. sdb1
+    :param table: a list of (block size, PartitionResult) tuples
+    :return: a dict with the units and the summary of every block size
+    """
+    sweep = []
+    for block_size, result in table:
+        block_size_report = partition_report(result)
+        del block_size_report["partition"]
+        block_size_report["block_size"] = block_size
+        sweep.append(block_size_report)
+    return {"partition": partition, "sweep": sweep}
+
+
+def buffered_speed(result, flushed=True):
+    """
+    :param result: a BufferedResult
+    :param flushed: include the fsync(), the syncfs() and the umount in
+        the time, otherwise only the write() calls are
+    :return: the speed in MB/s
+    """
+    seconds = result.write_seconds
+    if flushed:
+        seconds += (
+            result.fsync_seconds
+            + result.syncfs_seconds
+            + (result.umount_seconds or 0.0)
+        )
+    return result.bytes / seconds / 1e6 if seconds else 0.0
+
+
+def format_buffered_result(result):
+    """
+    :param result: a BufferedResult
+    :return: a one line summary of the phases of the write
+    """
+    text = (
+        "write() {:.3f} s ({:.3f} MB/s), fsync {:.3f} s, "
+        "syncfs {:.3f} s".format(
+            result.write_seconds,
+            buffered_speed(result, False),
+            result.fsync_seconds,
+            result.syncfs_seconds,
+        )
+    )
+    if result.umount_seconds is not None:
+        text += ", umount {:.3f} s".format(result.umount_seconds)
+    return text + ", {:.3f} MB/s end to end".format(buffered_speed(result))
+
+
+def buffered_report(partition, results):
+    """
+    :param partition: the partition tested, e.g. sdb1
+    :param results: a list of BufferedResult
+    :return: a dict with the phases and the speeds of every write
+    """
+    units = []
+    for result in results:
+        unit = result._asdict()
+        unit["write_speed"] = buffered_speed(result, False)
+        unit["speed"] = buffered_speed(result)
+        units.append(unit)
+    return {
+        "partition": partition,
+        "units": units,
+        "write_speed": statistics.mean(unit["write_speed"] for unit in units),
+        "speed": statistics.mean(unit["speed"] for unit in units),
+    }
+
+
+def sustained_report(partition, samples):
+    """
+    :param partition: the partition tested, e.g. sdb1
+    :param samples: a list of Sample
+    :return: a dict of the samples and of the detected cache boundary
+    """
+    boundary, burst_speed, steady_speed = find_cache_boundary(samples)
+    return {
+        "partition": partition,
+        "sustained": {
+            "samples": [sample._asdict() for sample in samples],
+            "cache_boundary": (
+                samples[boundary - 1].bytes if boundary is not None else None
+            ),
+            "burst_speed": burst_speed,
+            "steady_speed": steady_speed,
+        },
+    }
+
+
+def scaling_report(partition, results):
+    """
+    :param partition: the partition tested, e.g. sdb1
+    :param results: a list of ScalingResult
+    :return: a dict with the units and the aggregate speed of both
+        directions for every number of streams
+    """
+    scaling = []
+    for result in results:
+        streams_report = {"streams": result.streams}
+        for direction in ScalingResult._fields[1:]:
+            units = getattr(result, direction)
+            streams_report[direction] = {
+                "units": [unit_report(unit) for unit in units],
+                "aggregate_speed": aggregate_speed(units),
+            }
+        scaling.append(streams_report)
+    return {"partition": partition, "scaling": scaling}
+
+
+def metadata_report(partition, results):
+    """
+    :param partition: the partition tested, e.g. sdb1
+    :param results: a list of PhaseResult
+    :return: a dict of the results of every phase
+    """
+    return {
+        "partition": partition,
+        "metadata": [result._asdict() for result in results],
+    }
+
+
+def commit_report(partition, result):
+    """
+    :param partition: the partition tested, e.g. sdb1
+    :param result: a CommitResult
+    :return: a dict of the result, with latency percentiles and histogram
+        in seconds instead of all latencies
+    """
+    latencies = array.array("d", sorted(result.latencies))
+    latency = collections.OrderedDict(
+        ("p{:g}".format(pct), percentile(latencies, pct))
+        for pct in LATENCY_PERCENTILES
+    )
+    latency["max"] = latencies[-1]
+    return {
+        "partition": partition,
+        "commits": result.commits,
+        "bytes": result.bytes,
+        "seconds": result.seconds,
+        "latency": latency,
+        "histogram": [
+            {"le": bound, "count": count}
+            for bound, count in latency_histogram(latencies)
+        ],
+    }
+
+
+def random_io_report(partition, results):
+    """
+    :param partition: the partition tested, e.g. sdb1
+    :param results: a list of (queue depth, operation, RandomIOResult)
+    :return: a dict of the results, with latency percentiles in seconds
+        instead of all latencies
+    """
+    random_io = []
+    for queue_depth, operation, result in results:
+        latency = collections.OrderedDict(
+            ("p{:g}".format(pct), percentile(result.latencies, pct))
+            for pct in LATENCY_PERCENTILES
+        )
+        latency["max"] = result.latencies[-1]
+        random_io.append(
+            {
+                "queue_depth": queue_depth,
+                "operation": operation,
+                "ops": result.ops,
+                "seconds": result.seconds,
+                "iops": result.iops,
+                "latency": latency,
+            }
+        )
+    return {"partition": partition, "random_io": random_io}
+
+
+def sustained_write(data, target, block_size, oflag, sample_size, seconds):
+    """
+    write data to target and sample the throughput on the way.
+
+    :param data: a RandomData object, its size is the maximum to write
+    :param target: the path of the file to create
+    :param block_size: the size of a single write in bytes
+    :param oflag: the dd style open flags of the target, e.g. "sync"
+    :param sample_size: the number of bytes written between two samples
+    :param seconds: the maximum duration of the write
+    :return: a list of Sample, the speed is the one of the sample only
+    """
+    flags = parse_oflag(oflag)
+    if flags & os.O_DIRECT and block_size % mmap.PAGESIZE:
+        raise ValueError(
+            "block size {} is not a multiple of the page size "
+            "required by O_DIRECT".format(block_size)
+        )
+    buf = mmap.mmap(-1, block_size)
+    # only write full blocks, so O_DIRECT never needs a partial one
+    max_bytes = data.size - data.size % block_size
+    deadline = seconds * 1e9
+    samples = []
+    fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | flags)
+    try:
+        total = 0
+        sample_start = total
+        start = last = time.perf_counter_ns()
+        while total < max_bytes:
+            data.readinto(buf, total)
+            total += os.write(fd, buf)
+            if total - sample_start >= sample_size or total >= max_bytes:
+                now = time.perf_counter_ns()
+                samples.append(
+                    Sample(
+                        (now - start) / 1e9,
+                        total,
+                        (total - sample_start) / (now - last) * 1e3,
+                    )
+                )
+                sample_start, last = total, now
+                if now - start >= deadline:
+                    break
+    finally:
+        os.close(fd)
+        buf.close()
+    return samples
+
+
+def find_cache_boundary(samples):
+    """
+    find a sharp and lasting drop in the throughput of samples.
+
+    Every split of the samples is tried, the one with the lowest ratio
+    between the mean speed after and before it is the boundary if that
+    ratio is below CACHE_DROP_RATIO.
+
+    :param samples: a non-empty list of Sample
+    :return: a tuple of the index of the first sample after the boundary
+        (None if no boundary is found), the mean speed before it and the
+        mean speed after it
+    """
+    speeds = [sample.speed for sample in samples]
+    prefix = list(itertools.accumulate(speeds, initial=0))
+    best, best_ratio = None, CACHE_DROP_RATIO
+    # keep a few samples on both sides to ignore single slow samples
+    min_samples = 3
+    for split in range(min_samples, len(speeds) - min_samples + 1):
+        before = prefix[split] / split
+        after = (prefix[-1] - prefix[split]) / (len(speeds) - split)
+        if before and after / before < best_ratio:
+            best, best_ratio = split, after / before
+    if best is None:
+        return None, statistics.mean(speeds), statistics.mean(speeds)
+    return (
+        best,
+        prefix[best] / best,
+        (prefix[-1] - prefix[best]) / (len(speeds) - best),
+    )
+
+
+def commit_latency(path, sizes, count, sync):
+    """
+    append small synchronous writes to a file and time every one of them.
+
+    :param path: the path of the file to create
+    :param sizes: a list of write sizes in bytes, cycled through
+    :param count: the number of writes
+    :param sync: "dsync" to open the file with O_DSYNC, or "fdatasync" to
+        call os.fdatasync() after every write
+    :return: a CommitResult
+    """
+    data = memoryview(os.urandom(max(sizes)))
+    dsync = sync == "dsync"
+    fd = os.open(
+        path,
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC | (os.O_DSYNC if dsync else 0),
+    )
+    latencies = array.array("d")
+    total = 0
+    try:
+        start = time.perf_counter_ns()
+        for size in itertools.islice(itertools.cycle(sizes), count):
+            commit_start = time.perf_counter_ns()
+            written = 0
+            while written < size:
+                written += os.write(fd, data[written:size])
+            if not dsync:
+                os.fdatasync(fd)
+            latencies.append((time.perf_counter_ns() - commit_start) / 1e9)
+            total += size
+        elapsed = time.perf_counter_ns() - start
+    finally:
+        os.close(fd)
+    return CommitResult(len(latencies), total, elapsed / 1e9, latencies)
+
+
+def random_io(path, operation, io_size, queue_depth, num_ops, oflag=""):
+    """
+    issue random reads or writes at io_size aligned offsets of a file.
+
+    queue_depth threads share the file descriptor and each of them keeps
+    one os.preadv() or os.pwrite() in flight, so up to queue_depth
+    operations are queued to the device at a time.
+
+    :param path: the path of an existing file to read or overwrite
+    :param operation: "read" or "write"
+    :param io_size: the size of every operation in bytes
+    :param queue_depth: the number of threads issuing operations
+    :param num_ops: the total number of operations
+    :param oflag: the dd style open flags of the file, e.g. "direct"
+    :return: a RandomIOResult, latencies are sorted and in seconds
+    """
+    flags = parse_oflag(oflag)
+    write = operation == "write"
+    fd = os.open(path, (os.O_RDWR if write else os.O_RDONLY) | flags)
+    try:
+        num_blocks = os.fstat(fd).st_size // io_size
+        if not num_blocks:
+            raise ValueError(
+                "{} is smaller than the I/O size {}".format(path, io_size)
+            )
+        if not flags & os.O_DIRECT:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+
+        def worker(seed, count):
+            rng = random.Random(seed)
+            buf = mmap.mmap(-1, io_size)
+            # every write copies the first block of the file, test data
+            # rather than zeros, to the random offsets, so the content of
+            # the file is not preserved, it is removed afterwards
+            os.preadv(fd, [buf], 0)
+            latencies = []
+            try:
+                for _ in range(count):
+                    offset = rng.randrange(num_blocks) * io_size
+                    start = time.perf_counter_ns()
+                    if write:
+                        os.pwrite(fd, buf, offset)
+                    else:
+                        os.preadv(fd, [buf], offset)
+                    latencies.append(time.perf_counter_ns() - start)
+            finally:
+                buf.close()
+            return latencies
+
+        counts = [
+            num_ops // queue_depth + (idx < num_ops % queue_depth)
+            for idx in range(queue_depth)
+        ]
+        start = time.perf_counter_ns()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=queue_depth
+        ) as executor:
+            futures = [
+                executor.submit(worker, seed, count)
+                for seed, count in enumerate(counts)
+            ]
+            latencies = sorted(
+                itertools.chain.from_iterable(f.result() for f in futures)
+            )
+        elapsed = time.perf_counter_ns() - start
+    finally:
+        os.close(fd)
+    seconds = elapsed / 1e9
+    return RandomIOResult(
+        len(latencies),
+        seconds,
+        len(latencies) / seconds if seconds else 0.0,
+        [latency / 1e9 for latency in latencies],
+    )
+
+
+def metadata_workload(folder, payload, num_files, fanout, threads):
+    """
+    create, fsync, stat, read and unlink small files in nested folders.
+
+    Every phase is run on all files before the next one starts and is
+    timed on its own. The files are spread over threads, each of them
+    handling every threads-th file. The cached pages of the files are
+    dropped once they are synced, so they are read from the device.
+
+    :param folder: an empty folder, the files are created below it
+    :param payload: the content of every file
+    :param num_files: the number of files
+    :param fanout: the maximum number of entries of every folder of the
+        tree, at least 2, the tree is as deep as needed
+    :param threads: the number of threads running every phase
+    :return: a list of PhaseResult, in the order of the phases
+    """
+    # levels of folders above the files
+    depth = 1
+    while fanout ** (depth + 1) < num_files:
+        depth += 1
+
+    def path(idx):
+        # the folders are the digits of the index in base fanout, but the
+        # last one
+        parts = ["f{}".format(idx)]
+        for _ in range(depth):
+            idx //= fanout
+            parts.append("{:x}".format(idx % fanout))
+        return os.path.join(folder, *reversed(parts))
+
+    def create(idx):
+        os.makedirs(os.path.dirname(path(idx)), exist_ok=True)
+        fd = os.open(path(idx), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            view = memoryview(payload)
+            while view:
+                view = view[os.write(fd, view) :]
+        finally:
+            os.close(fd)
+
+    def fsync(idx):
+        fd = os.open(path(idx), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+    def stat(idx):
+        size = os.stat(path(idx)).st_size
+        if size != len(payload):
+            raise ValueError(
+                "{} has {} bytes instead of {}".format(
+                    path(idx), size, len(payload)
+                )
+            )
+
+    def read(idx):
+        with open(path(idx), "rb", buffering=0) as f:
+            if f.read(len(payload) + 1) != payload:
+                raise ValueError(
+                    "{} differs from the data written".format(path(idx))
+                )
+
+    def unlink(idx):
+        os.unlink(path(idx))
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        for operation in (create, fsync, stat, read, unlink):
+            start = time.perf_counter_ns()
+            # list() re-raises the first error of the threads
+            list(
+                pool.map(
+                    lambda first: [
+                        operation(idx)
+                        for idx in range(first, num_files, threads)
+                    ],
+                    range(threads),
+                )
+            )
+            seconds = (time.perf_counter_ns() - start) / 1e9
+            results.append(
+                PhaseResult(
+                    operation.__name__,
+                    num_files,
+                    seconds,
+                    num_files / seconds if seconds else 0.0,
+                )
+            )
+    return results
+
+
+def percentile(sorted_values, pct):
+    """
+    get a percentile of sorted values with the nearest-rank method.
+
+    :param sorted_values: a non-empty sorted list of numbers
+    :param pct: the percentile to get, from 0 to 100
+    :return: the value at the percentile
+    """
+    rank = math.ceil(pct / 100 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def latency_histogram(latencies):
+    """
+    count latencies in buckets growing by powers of two.
+
+    :param latencies: a non-empty sorted sequence of latencies in seconds
+    :return: a list of (upper bound in seconds, count) tuples, from the
+        bucket of the lowest latency to the one of the highest, the upper
+        bounds are powers of two microseconds
+    """
+    counts = collections.Counter(
+        max(math.ceil(math.log2(latency * 1e6)), 0) if latency > 0 else 0
+        for latency in latencies
+    )
+    return [
+        (2**exponent / 1e6, counts[exponent])
+        for exponent in range(min(counts), max(counts) + 1)
+    ]
+
+
+def format_latencies(latencies):
+    """
+    :param latencies: a non-empty sorted sequence of latencies in seconds
+    :return: a string with the LATENCY_PERCENTILES and maximum in ms
+    """
+    fields = [
+        "p{:g} {:.3f}".format(pct, percentile(latencies, pct) * 1e3)
+        for pct in LATENCY_PERCENTILES
+    ]
+    fields.append("max {:.3f}".format(latencies[-1] * 1e3))
+    return " ".join(fields)
+
+
+def report_aggregate_bandwidth(solo_results, concurrent_results):
+    """
+    compare the devices tested alone with the devices tested concurrently.
+
+    The sum of the average speeds of the devices behind one host
+    controller is compared between both runs. A ratio well below 100%
+    means the devices are limited by the bandwidth they share.
+
+    :param solo_results: a list of PartitionResult, tested one by one
+    :param concurrent_results: a list of PartitionResult, tested together
+    """
+    controllers = collections.OrderedDict()
+    for solo, together in zip(solo_results, concurrent_results):
+        controller = host_controller(solo.partition)
+        controllers.setdefault(controller, []).append((solo, together))
+    for controller, pairs in controllers.items():
+        print(
+            "Host controller {} ({}):".format(
+                controller, " ".join(solo.partition for solo, _ in pairs)
+            )
+        )
+        for direction in PartitionResult._fields[1:]:
+            alone = sum(
+                average_speed(getattr(solo, direction)) for solo, _ in pairs
+            )
+            together = sum(
+                average_speed(getattr(together, direction))
+                for _, together in pairs
+            )
+            print(
+                "  aggregate {} speed: {:.3f} MB/s concurrently, "
+                "{:.3f} MB/s one by one ({:.1f}%)".format(
+                    direction,
+                    together,
+                    alone,
+                    together / alone * 100 if alone else 0.0,
+                )
+            )
+
+
+def host_controller(partition):
+    """
+    find the USB host controller a partition is connected to.
+
+    :param partition: a partition name, e.g. sdb1
+    :return: the sysfs name of the controller, e.g. 0000:00:14.0,
+        or "unknown" if the partition is not on a USB bus
+    """
+    path = os.path.realpath(os.path.join("/sys/class/block", partition))
+    nodes = path.split(os.sep)
+    for parent, node in zip(nodes, nodes[1:]):
+        # usbN is the root hub, its parent is the host controller
+        if re.fullmatch(r"usb\d+", node):
+            return parent
+    return "unknown"
+
+
+def print_device_stats(device_stats):
+    """
+    print the statistics of the disk a test unit ran on.
+
+    :param device_stats: a dict of DeviceStats, a partition followed by its
+        disk, as found by block_devices()
+    """
+    if device_stats:
+        device, stats = list(device_stats.items())[-1]
+        print("  " + format_device_stats(device, stats))
+
+
+def aggregate_speed(results):
+    """
+    :param results: a list of IOResult of transfers that started together
+    :return: the speed of all the transfers together in MB/s, until the
+        last one ended
+    """
+    seconds = max(result.seconds for result in results)
+    return sum(result.bytes for result in results) / seconds / 1e6
+
+
+def average_speed(results):
+    """
+    :param results: a list of IOResult
+    :return: the average speed of the results in MB/s
+    """
+    return sum(result.speed for result in results) / len(results)
+
+
+@contextlib.contextmanager
+def mount_usb_storage(partition, folder, metrics=None):
+    """
+    initialize the configuration so we could get ready to test jobs.
+
+    get everything ready to have the read/write test, including
+    1. reuse a writable mount of the partition if there is one
+    2. otherwise un-mount the folder if something is mounted on it, and
+       mount the partition on it with its detected filesystem type
+
+    :param partition: the partition to mount, e.g. sdb1
+    :param folder: the mount point, if the partition has to be mounted
+    :param metrics: a list the metrics of the mount are appended to, as a
+        dict with the mount and umount latency in seconds
+    :return: the mount point
+    """
+    logging.debug("try to mount usb storage for testing")
+    device_to_mount = os.path.join("/dev", partition)
     try:
-        # return the md5sum of the temp file
-        process = subprocess.Popen(
-            ["md5sum", file_to_check], stdout=subprocess.PIPE
+        st_rdev = os.stat(device_to_mount).st_rdev
+    except OSError as e:
+        logging.error("cannot access %s: %s", device_to_mount, e)
+        sys.exit(1)
+    device = (os.major(st_rdev), os.minor(st_rdev))
+    mounts = mount_info()
+    metric = {
+        "partition": partition,
+        "mount_point": folder,
+        "fs_type": None,
+        "reused": False,
+        "mount_seconds": 0.0,
+        "umount_seconds": 0.0,
+    }
+    if metrics is not None:
+        metrics.append(metric)
+    mount = find_reusable_mount(device, mounts)
+    if mount is not None:
+        # mounted by someone else, so it is left mounted afterwards
+        logging.info(
+            "reuse the %s mount of %s on %s",
+            mount.fs_type,
+            device_to_mount,
+            mount.mount_point,
+        )
+        metric.update(
+            mount_point=mount.mount_point, fs_type=mount.fs_type, reused=True
+        )
+        yield mount.mount_point
+        return
+    # only un-mount the folder if a previous run left something on it
+    if any(mount.mount_point == os.path.realpath(folder) for mount in mounts):
+        try:
+            umount_partition(folder)
+        except OSError as e:
+            logging.warning("umount %s failed: %s", folder, e)
+    fs_type = filesystem_type(device_to_mount)
+    metric["fs_type"] = fs_type
+    start = time.perf_counter()
+    try:
+        mount_partition(device_to_mount, folder, fs_type)
+    except OSError as e:
+        # quit this script and return a non-zero value to plainbox
+        logging.error("mount %s on %s failed: %s", device_to_mount, folder, e)
+        sys.exit(1)
+    metric["mount_seconds"] = time.perf_counter() - start
+    logging.debug(
+        "mount %s (%s) on %s successfully in %.3f s.",
+        device_to_mount,
+        fs_type or "unknown filesystem",
+        folder,
+        metric["mount_seconds"],
+    )
+    try:
+        yield folder
+    finally:
+        logging.info("context manager exit: unmount USB storage")
+        start = time.perf_counter()
+        try:
+            umount_partition(folder)
+        except OSError as e:
+            logging.warning("umount %s failed: %s", folder, e)
+        else:
+            metric["umount_seconds"] = time.perf_counter() - start
+            logging.info(
+                "umount %s successfully in %.3f s.",
+                folder,
+                metric["umount_seconds"],
+            )
+
+
+def mount_info(path="/proc/self/mountinfo"):
+    """
+    parse the mount table of the process.
+
+    :param path: the path of a file in the mountinfo format
+    :return: a list of MountInfo, the device is a (major, minor) tuple and
+        the options are sets
+    """
+    mounts = []
+    with open(path) as mountinfo:
+        for line in mountinfo:
+            fields = line.split()
+            # a variable number of optional fields ends with a "-"
+            separator = fields.index("-", 6)
+            major, minor = fields[2].split(":")
+            mounts.append(
+                MountInfo(
+                    (int(major), int(minor)),
+                    _unescape_mount_field(fields[3]),
+                    _unescape_mount_field(fields[4]),
+                    set(fields[5].split(",")),
+                    fields[separator + 1],
+                    _unescape_mount_field(fields[separator + 2]),
+                    (
+                        set(fields[separator + 3].split(","))
+                        if len(fields) > separator + 3
+                        else set()
+                    ),
+                )
+            )
+    return mounts
+
+
+def _unescape_mount_field(field):
+    # spaces, tabs, newlines and backslashes are escaped in octal
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+def find_reusable_mount(device, mounts):
+    """
+    find a mount of the whole filesystem of a device the test can write to.
+
+    :param device: the (major, minor) tuple of the device
+    :param mounts: a list of MountInfo
+    :return: a MountInfo, or None if the device has no such mount
+    """
+    for mount in mounts:
+        if (
+            mount.device == device
+            and mount.root == "/"
+            and "rw" in mount.options
+            and "rw" in mount.super_options
+            and os.access(mount.mount_point, os.W_OK)
+        ):
+            return mount
+    return None
+
+
+def filesystem_type(path):
+    """
+    detect the filesystem type of a block device.
+
+    The type probed by udev is used if the udev database is readable,
+    blkid probes the device otherwise.
+
+    :param path: the path of the device, e.g. /dev/sdb1
+    :return: the filesystem type, e.g. "vfat", or None if it is unknown
+    """
+    st_rdev = os.stat(path).st_rdev
+    udev_data_path = "/run/udev/data/b{}:{}".format(
+        os.major(st_rdev), os.minor(st_rdev)
+    )
+    try:
+        with open(udev_data_path) as udev_data:
+            for line in udev_data:
+                if line.startswith("E:ID_FS_TYPE="):
+                    return line.strip().partition("=")[2] or None
+    except OSError:
+        pass
+    try:
+        output = subprocess.check_output(
+            ["blkid", "-o", "value", "-s", "TYPE", path],
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.strip() or None
+
+
+def kernel_filesystems():
+    """
+    :return: a set of the filesystem types the kernel can mount itself
+    """
+    with open("/proc/filesystems") as filesystems:
+        return {line.split()[-1] for line in filesystems if line.strip()}
+
+
+def mount_partition(device, folder, fs_type=None):
+    """
+    mount a block device on a folder.
+
+    The mount(2) system call is used directly if the kernel supports the
+    filesystem type, the mount command is used otherwise, e.g. for FUSE
+    filesystems or when the type is unknown.
+
+    :param device: the path of the device, e.g. /dev/sdb1
+    :param folder: the mount point
+    :param fs_type: the filesystem type of the device, or None
+    :raises OSError: if the mount failed
+    """
+    if fs_type and fs_type in kernel_filesystems():
+        _libc_call("mount", device, folder, fs_type, 0, None)
+        return
+    command = ["mount", device, folder]
+    if fs_type:
+        command[1:1] = ["-t", fs_type]
+    process = subprocess.run(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    if process.returncode:
+        raise OSError(errno.EIO, process.stdout.decode().strip())
+
+
+def umount_partition(folder):
+    """
+    :param folder: the mount point to un-mount
+    :raises OSError: if the umount failed
+    """
+    _libc_call("umount2", folder, 0)
+
+
+def _libc_call(name, *args):
+    # only needed to mount and to sync filesystems, ctypes is slow to import
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    args = [arg.encode() if isinstance(arg, str) else arg for arg in args]
+    if getattr(libc, name)(*args):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def sync_filesystem(path):
+    """
+    write back the dirty data of the filesystem of path with syncfs(2).
+
+    :param path: a file or a folder on the filesystem
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        _libc_call("syncfs", fd)
+    finally:
+        os.close(fd)
+
+
+def buffered_write(source, target, block_size):
+    """
+    write source to target through the page cache, then flush it.
+
+    :param source: the path of the file to copy, or a RandomData object
+    :param target: the path of the file to create
+    :param block_size: the size of a single write in bytes
+    :return: a BufferedResult without the umount time
+    """
+    result = native_write(source, target, block_size, "")
+    fd = os.open(target, os.O_WRONLY)
+    try:
+        start = time.perf_counter()
+        os.fsync(fd)
+        fsync_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        _libc_call("syncfs", fd)
+        syncfs_seconds = time.perf_counter() - start
+    finally:
+        os.close(fd)
+    return BufferedResult(
+        result.bytes, result.seconds, fsync_seconds, syncfs_seconds
+    )
+
+
+def io_result(total, seconds, cpu_seconds=None):
+    """
+    build an IOResult from a byte count and the time it took.
+
+    :param total: the number of bytes transferred
+    :param seconds: the elapsed time in seconds
+    :param cpu_seconds: the user and system CPU time of the transfer
+    :return: an IOResult, its speed is in MB/s (10^6 bytes per second)
+    """
+    return IOResult(
+        total,
+        seconds,
+        total / seconds / 1e6 if seconds else 0.0,
+        cpu_seconds=cpu_seconds,
+    )
+
+
+def parse_size(size):
+    """
+    convert a dd style size string to a number of bytes.
+
+    :param size: a string such as "4096", "64K", "1M" or "4G"
+    :return: the size in bytes as an integer
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*([KMG]?)i?B?\s*", str(size), re.I)
+    if not match or not int(match.group(1)):
+        raise ValueError("invalid size: {}".format(size))
+    return int(match.group(1)) * SIZE_SUFFIXES[match.group(2).upper()]
+
+
+def parse_oflag(oflag):
+    """
+    convert a comma separated dd style oflag string to os.open() flags.
+
+    :param oflag: a string such as "sync", "dsync" or "direct,sync"
+    :return: the flags as an integer
+    """
+    flags = 0
+    for name in filter(None, oflag.split(",")):
+        try:
+            flags |= OFLAGS[name]
+        except KeyError:
+            raise ValueError("unsupported oflag: {}".format(name))
+    return flags
+
+
+def native_write(source, target, block_size, oflag):
+    """
+    copy source to target with os.write() in block_size chunks.
+
+    The data goes through a page-aligned anonymous mmap buffer, so the
+    target can be opened with O_DIRECT. A trailing partial block is
+    written after dropping O_DIRECT, as dd does.
+
+    :param source: the path of the file to copy, or a RandomData object
+        whose data is written without going through its file
+    :param target: the path of the file to create
+    :param block_size: the size of a single write in bytes
+    :param oflag: the dd style open flags of the target, e.g. "sync"
+    :return: an IOResult
+    """
+    flags = parse_oflag(oflag)
+    direct = bool(flags & os.O_DIRECT)
+    if direct and block_size % mmap.PAGESIZE:
+        raise ValueError(
+            "block size {} is not a multiple of the page size "
+            "required by O_DIRECT".format(block_size)
+        )
+    buf = mmap.mmap(-1, block_size)
+    view = memoryview(buf)
+    if isinstance(source, RandomData):
+        src = None
+    else:
+        src = os.open(source, os.O_RDONLY)
+    try:
+        dst = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | flags)
+        total = 0
+        start = time.perf_counter_ns()
+        cpu_start = time.thread_time_ns()
+        try:
+            while True:
+                if src is None:
+                    size = source.readinto(buf, total)
+                else:
+                    size = os.readv(src, [buf])
+                if not size:
+                    break
+                if direct and size % mmap.PAGESIZE:
+                    fcntl.fcntl(
+                        dst,
+                        fcntl.F_SETFL,
+                        fcntl.fcntl(dst, fcntl.F_GETFL) & ~os.O_DIRECT,
+                    )
+                    direct = False
+                written = 0
+                while written < size:
+                    written += os.write(dst, view[written:size])
+                total += size
+        finally:
+            os.close(dst)
+        elapsed = time.perf_counter_ns() - start
+        cpu = time.thread_time_ns() - cpu_start
+    finally:
+        if src is not None:
+            os.close(src)
+        view.release()
+        buf.close()
+    return io_result(total, elapsed / 1e9, cpu / 1e9)
+
+
+def compare_with_source(path, random_file, block_size):
+    """
+    compare a file with the test data it should hold, block by block.
+
+    :param path: the path of the file to check
+    :param random_file: a RandomData object providing the expected data
+    :param block_size: the size of the blocks compared at once
+    :return: the offset of the first differing byte, or None if the file
+        and the test data are identical
+    """
+    expected = bytearray(block_size)
+    actual = bytearray(block_size)
+    offset = 0
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(actual)
+            expected_size = random_file.readinto(expected, offset)
+            if size != expected_size or actual[:size] != expected[:size]:
+                length = min(size, expected_size)
+                return offset + next(
+                    (i for i in range(length) if actual[i] != expected[i]),
+                    length,
+                )
+            if not size:
+                return None
+            offset += size
+
+
+def verify_chunks(path, random_file, chunk_size, algorithm, stop_early):
+    """
+    compare a file with the test data using the digests of its chunks.
+
+    Only the chunks whose digest differs from the one of the test data are
+    compared byte by byte, to find the exact ranges that differ.
+
+    :param path: the path of the file to check
+    :param random_file: a RandomData object providing the expected data
+    :param chunk_size: the size of the chunks in bytes
+    :param algorithm: a key of CHUNK_DIGESTS
+    :param stop_early: stop the comparison at the first chunk that
+        differs, the ranges after it are not reported
+    :return: a sorted list of (start, end) tuples of the byte ranges that
+        differ, missing and extra data included, empty if the file and the
+        test data are identical
+    """
+    digest = CHUNK_DIGESTS[algorithm]
+    expected_digests = random_file.chunk_digests(chunk_size, algorithm)
+    actual = bytearray(chunk_size)
+    expected = bytearray(chunk_size)
+    ranges = []
+    with open(path, "rb", buffering=0) as f:
+        for idx, expected_digest in enumerate(expected_digests):
+            offset = idx * chunk_size
+            size = f.readinto(actual)
+            if digest(memoryview(actual)[:size]) == expected_digest:
+                continue
+            expected_size = random_file.readinto(expected, offset)
+            common = min(size, expected_size)
+            ranges.extend(
+                diff_ranges(actual[:common], expected[:common], offset)
+            )
+            if size < expected_size:
+                # the file is truncated, the rest of the data is missing
+                ranges.append((offset + size, random_file.size))
+                break
+            if stop_early:
+                break
+        file_size = os.fstat(f.fileno()).st_size
+    if file_size > random_file.size:
+        ranges.append((random_file.size, file_size))
+    return merge_ranges(ranges)
+
+
+def diff_ranges(actual, expected, offset=0):
+    """
+    find the byte ranges where two buffers of the same size differ.
+
+    :param actual: a bytes-like object
+    :param expected: a bytes-like object of the same size
+    :param offset: the offset of the buffers, added to the ranges
+    :return: a list of (start, end) tuples, end excluded
+    """
+    ranges = []
+    # skip the identical sectors without a byte by byte comparison
+    sector = 512
+    for start in range(0, len(actual), sector):
+        end = min(start + sector, len(actual))
+        if actual[start:end] == expected[start:end]:
+            continue
+        for idx in range(start, end):
+            if actual[idx] != expected[idx]:
+                if ranges and ranges[-1][1] == offset + idx:
+                    ranges[-1] = (ranges[-1][0], offset + idx + 1)
+                else:
+                    ranges.append((offset + idx, offset + idx + 1))
+    return ranges
+
+
+def merge_ranges(ranges):
+    """
+    :param ranges: a list of (start, end) tuples sorted by start
+    :return: a list of (start, end) tuples where overlapping and adjacent
+        ranges are merged
+    """
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def format_ranges(ranges, limit=10):
+    """
+    :param ranges: a non-empty list of (start, end) tuples, end excluded
+    :param limit: the maximum number of ranges listed
+    :return: a string listing the ranges, e.g. "4096-8191, 12288-12288"
+    """
+    text = ", ".join(
+        "{}-{}".format(start, end - 1) for start, end in ranges[:limit]
+    )
+    if len(ranges) > limit:
+        text += " and {} more ranges".format(len(ranges) - limit)
+    return text
+
+
+def timed_read(path, block_size, iflag=""):
+    """
+    read a file from the device and time it.
+
+    Unless iflag asks for O_DIRECT, dirty pages of the file are flushed
+    and its cached pages are dropped with POSIX_FADV_DONTNEED first, so
+    the data has to come from the device and not from the page cache.
+
+    :param path: the path of the file to read
+    :param block_size: the size of a single read in bytes
+    :param iflag: the dd style open flags of the file, e.g. "direct"
+    :return: an IOResult
+    """
+    flags = parse_oflag(iflag)
+    buf = mmap.mmap(-1, block_size)
+    fd = os.open(path, os.O_RDONLY | flags)
+    try:
+        if not flags & os.O_DIRECT:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        total = 0
+        start = time.perf_counter_ns()
+        while True:
+            size = os.readv(fd, [buf])
+            if not size:
+                break
+            total += size
+        elapsed = time.perf_counter_ns() - start
+    finally:
+        os.close(fd)
+        buf.close()
+    return io_result(total, elapsed / 1e9)
+
+
+def dd_write(source, target, block_size, oflag):
+    """
+    copy source to target with a dd subprocess.
+
+    dd runs in the C locale and only the byte count and the elapsed time
+    are taken from its report, so the speed does not depend on the unit
+    dd picks for it.
+
+    :param source: the path of the file to copy, or a RandomData object
+        backed by a file
+    :param target: the path of the file to create
+    :param block_size: the size of a single write in bytes
+    :param oflag: the dd style open flags of the target, e.g. "sync"
+    :return: an IOResult, its CPU time is the one of the children of this
+        process that ended meanwhile
+    """
+    source = source_path(source, "dd")
+    command = [
+        "dd",
+        "if=" + source,
+        "of=" + target,
+        "bs={}".format(block_size),
+    ]
+    if oflag:
+        command.append("oflag=" + oflag)
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    process = subprocess.run(
+        command,
+        stderr=subprocess.STDOUT,
+        stdout=subprocess.PIPE,
+        env=dict(os.environ, LC_ALL="C"),
+    )
+    dd_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    logging.debug("Apply command: %s" % process.args)
+    # will get something like
+    # ['2048+1 records in', '2048+1 records out',
+    # '1049076 bytes (1.0 MB) copied, 0.00473357 s, 222 MB/s', '']
+    dd_message = process.stdout.decode()
+    logging.debug(dd_message.split("\n"))
+    match = re.search(r"^(\d+) bytes .*copied, ([0-9.]+) s", dd_message, re.M)
+    if process.returncode or not match:
+        # Example:
+        # ['dd: writing to ‘/tmp/tmp08osy45j/tmpnek46on30’: Input/output error'
+        # , '38913+0 records in', '38912+0 records out', '19922944 bytes
+        # (20 MB) copied, 99.647 s, 200 kB/s', '']
+        raise OSError(errno.EIO, dd_message.strip())
+    return io_result(
+        int(match.group(1)),
+        float(match.group(2)),
+        dd_usage.ru_utime
+        - usage.ru_utime
+        + dd_usage.ru_stime
+        - usage.ru_stime,
+    )
+
+
+def source_path(source, engine):
+    """
+    :param source: the path of a file, or a RandomData object
+    :param engine: the name of the write engine, for the error message
+    :return: the path of the file, the one backing the RandomData object
+    """
+    if isinstance(source, RandomData):
+        if source.tfile is None:
+            raise ValueError(
+                "the {} engine needs a source file".format(engine)
+            )
+        return source.tfile.name
+    return source
+
+
+def userspace_write(source, target, block_size, oflag):
+    """
+    copy the source file to target with os.readv() and os.write().
+
+    Unlike the native engine, the data is read from the source file, so
+    the copy costs what a plain userspace copy (e.g. cp or dd) does.
+
+    :param source: the path of the file to copy, or a RandomData object
+        backed by a file
+    :param target: the path of the file to create
+    :param block_size: the size of a single write in bytes
+    :param oflag: the dd style open flags of the target, e.g. "sync"
+    :return: an IOResult
+    """
+    return native_write(
+        source_path(source, "userspace"), target, block_size, oflag
+    )
+
+
+def direct_write(source, target, block_size, oflag):
+    """
+    copy the source file to target as userspace_write() does, with the
+    target opened with O_DIRECT to bypass the page cache.
+
+    :param source: the path of the file to copy, or a RandomData object
+        backed by a file
+    :param target: the path of the file to create
+    :param block_size: the size of a single write in bytes, a multiple of
+        the page size
+    :param oflag: the dd style open flags of the target, "direct" is added
+    :return: an IOResult
+    """
+    return native_write(
+        source_path(source, "direct"),
+        target,
+        block_size,
+        ",".join(filter(None, [oflag, "direct"])),
+    )
+
+
+def kernel_copy(copy, source, target, block_size, oflag):
+    """
+    copy source to target with a system call copying in the kernel.
+
+    The data is not copied to and from userspace buffers, the CPU time is
+    the one spent in the system calls.
+
+    :param copy: a function called with the source and the target file
+        descriptors and a byte count, returning the number of bytes copied
+        from the current offset of the source to the one of the target
+    :param source: the path of the file to copy
+    :param target: the path of the file to create
+    :param block_size: the number of bytes copied by a single call
+    :param oflag: the dd style open flags of the target, e.g. "sync"
+    :return: an IOResult
+    """
+    flags = parse_oflag(oflag)
+    src = os.open(source, os.O_RDONLY)
+    try:
+        dst = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | flags)
+        total = 0
+        start = time.perf_counter_ns()
+        cpu_start = time.thread_time_ns()
+        try:
+            while True:
+                size = copy(src, dst, block_size)
+                if not size:
+                    break
+                total += size
+        finally:
+            os.close(dst)
+        elapsed = time.perf_counter_ns() - start
+        cpu = time.thread_time_ns() - cpu_start
+    finally:
+        os.close(src)
+    return io_result(total, elapsed / 1e9, cpu / 1e9)
+
+
+def copy_file_range_write(source, target, block_size, oflag):
+    """
+    copy the source file to target with os.copy_file_range().
+
+    Between two filesystems, Linux 5.3 to 5.18 fall back to splicing the
+    data in the kernel, later versions fail with EXDEV unless the
+    filesystem implements the copy itself, as NFS or CIFS do.
+
+    :param source: the path of the file to copy, or a RandomData object
+        backed by a file
+    :param target: the path of the file to create
+    :param block_size: the number of bytes copied by a single call
+    :param oflag: the dd style open flags of the target, e.g. "sync"
+    :return: an IOResult
+    """
+    source = source_path(source, "copy_file_range")
+    try:
+        return kernel_copy(
+            os.copy_file_range, source, target, block_size, oflag
+        )
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        raise OSError(
+            e.errno,
+            "copy_file_range cannot copy {} to {}, this kernel does not "
+            "copy between these filesystems".format(source, target),
         )
-        # something like
-        # (b'07bc8f96b7c7dba2c1f3eb2f7dd50541  /tmp/tmp9jnuv329\n', None)
-        # will be returned by communicate() in this case
-        md5sum = process.communicate()[0].decode().split(" ")[0]
+
+
+def sendfile_write(source, target, block_size, oflag):
+    """
+    copy the source file to target with os.sendfile().
+
+    :param source: the path of the file to copy, or a RandomData object
+        backed by a file
+    :param target: the path of the file to create
+    :param block_size: the number of bytes copied by a single call
+    :param oflag: the dd style open flags of the target, e.g. "sync"
+    :return: an IOResult
+    """
+    return kernel_copy(
+        lambda src, dst, count: os.sendfile(dst, src, None, count),
+        source_path(source, "sendfile"),
+        target,
+        block_size,
+        oflag,
+    )
+
+
+# the engines copying the source file instead of writing the test data
+# from memory
+FILE_WRITE_ENGINES = (
+    "dd",
+    "userspace",
+    "direct",
+    "copy_file_range",
+    "sendfile",
+)
+WRITE_ENGINES = {
+    "native": native_write,
+    "dd": dd_write,
+    "userspace": userspace_write,
+    "direct": direct_write,
+    "copy_file_range": copy_file_range_write,
+    "sendfile": sendfile_write,
+}
+# digests of the chunk verification, faster than md5 and per chunk
+CHUNK_DIGESTS = {
+    "crc32": zlib.crc32,
+    "blake2b": lambda data: hashlib.blake2b(data, digest_size=16).digest(),
+}
+
+
+def get_md5sum(file_to_check):
+    """
+    get md5sum of file_to_check.
+
+    :param file_to_check: the absolute path of a file to access its md5sum
+    :return: md5sum as a string
+    """
+    try:
+        # return the md5sum of the temp file
+        md5sum = hash_file(file_to_check)
         if md5sum:
             logging.debug("MD5SUM of %s: %s" % (file_to_check, md5sum))
             return md5sum
@@ -386,5 +4120,12 @@ def get_md5sum(file_to_check):
             sys.exit(1)
 
 
+def main():
+    """read the configuration from the environment and run the test."""
+    config = Config()
+    init_logger(config.session_share)
+    UsbRwTest(config).run()
+
+
 if __name__ == "__main__":
-    run_read_write_test()
+    main()
@@ -0,0 +1,986 @@
+import contextlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+import usb_read_write
+
+
+class TestRandomData(unittest.TestCase):
+    def setUp(self):
+        self.size = 1024 * 1024 + 777
+        self.random_file = usb_read_write.RandomData(self.size)
+        self.addCleanup(os.unlink, self.random_file.tfile.name)
+
+    def test_file_matches_generator(self):
+        data = self.random_file._generate_test_data()
+        expected = b""
+        while len(expected) < self.size:
+            expected += next(data).encode("UTF-8")
+        with open(self.random_file.tfile.name, "rb") as f:
+            self.assertEqual(f.read(), expected[: self.size])
+
+    def test_md5sum(self):
+        self.assertEqual(
+            self.random_file.md5sum,
+            usb_read_write.hash_file(self.random_file.tfile.name),
+        )
+
+    def test_streamed_readinto(self):
+        streamed = usb_read_write.RandomData(self.size, streamed=True)
+        self.assertIsNone(streamed.tfile)
+        with open(self.random_file.tfile.name, "rb") as f:
+            data = f.read()
+        buf = bytearray(100003)
+        offset = 500000
+        size = streamed.readinto(buf, offset)
+        self.assertEqual(bytes(buf[:size]), data[offset : offset + size])
+        self.assertEqual(streamed.readinto(buf, self.size), 0)
+
+    def test_compare_with_source(self):
+        streamed = usb_read_write.RandomData(self.size, streamed=True)
+        path = self.random_file.tfile.name
+        self.assertIsNone(
+            usb_read_write.compare_with_source(path, streamed, 65536)
+        )
+        with open(path, "r+b") as f:
+            f.seek(300000)
+            f.write(b"\0")
+        self.assertEqual(
+            usb_read_write.compare_with_source(path, streamed, 65536), 300000
+        )
+        with open(path, "r+b") as f:
+            f.truncate(200000)
+        self.assertEqual(
+            usb_read_write.compare_with_source(path, streamed, 65536), 200000
+        )
+
+    def test_verify_chunks(self):
+        path = self.random_file.tfile.name
+        for algorithm in ("crc32", "blake2b"):
+            self.assertEqual(
+                usb_read_write.verify_chunks(
+                    path, self.random_file, 65536, algorithm, False
+                ),
+                [],
+            )
+        with open(path, "r+b") as f:
+            f.seek(70000)
+            f.write(b"\0\0\0")
+            f.seek(600000)
+            f.write(b"\0")
+        self.assertEqual(
+            usb_read_write.verify_chunks(
+                path, self.random_file, 65536, "crc32", False
+            ),
+            [(70000, 70003), (600000, 600001)],
+        )
+        self.assertEqual(
+            usb_read_write.verify_chunks(
+                path, self.random_file, 65536, "crc32", True
+            ),
+            [(70000, 70003)],
+        )
+        with open(path, "r+b") as f:
+            f.truncate(200000)
+        self.assertEqual(
+            usb_read_write.verify_chunks(
+                path, self.random_file, 65536, "blake2b", False
+            ),
+            [(70000, 70003), (200000, self.size)],
+        )
+        with open(path, "ab") as f:
+            f.write(b"\0" * (self.size - 200000 + 10))
+        self.assertEqual(
+            usb_read_write.verify_chunks(
+                path, self.random_file, 65536, "crc32", False
+            )[-1],
+            (200000, self.size + 10),
+        )
+
+
+class TestUsbReadWriteFunctions(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(usb_read_write.parse_size("4096"), 4096)
+        self.assertEqual(usb_read_write.parse_size("64K"), 65536)
+        self.assertEqual(usb_read_write.parse_size("1MiB"), 1024**2)
+        for size in ("", "0", "1T", "K"):
+            with self.assertRaises(ValueError):
+                usb_read_write.parse_size(size)
+
+    def test_parse_oflag(self):
+        self.assertEqual(usb_read_write.parse_oflag(""), 0)
+        self.assertEqual(
+            usb_read_write.parse_oflag("direct,sync"),
+            os.O_DIRECT | os.O_SYNC,
+        )
+        with self.assertRaises(ValueError):
+            usb_read_write.parse_oflag("nocache")
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(usb_read_write.percentile(values, 50), 50)
+        self.assertEqual(usb_read_write.percentile(values, 99.9), 100)
+        self.assertEqual(usb_read_write.percentile(values, 0), 1)
+
+    def test_aggregate_speed(self):
+        results = [
+            usb_read_write.IOResult(10**6, 1.0, 1.0),
+            usb_read_write.IOResult(10**6, 2.0, 0.5),
+        ]
+        # both transfers ran together until the slower one ended
+        self.assertEqual(usb_read_write.aggregate_speed(results), 1.0)
+
+    def test_cpu_statistics(self):
+        def result(start, end, iowait):
+            return usb_read_write.IOResult(
+                5 * 10**8,
+                1.0,
+                500.0,
+                cpu_usage=usb_read_write.CpuStats(
+                    0.5, 1.0, 1.0, 2.0, iowait, 0.5, 0.5, 2.0, start, end
+                ),
+            )
+
+        # the second unit ran during the first one, the third one after
+        results = [result(0.0, 1.0, 4.0), result(0.5, 1.5, 4.0)]
+        results.append(result(1.5, 2.0, 14.0))
+        cpu = usb_read_write.cpu_statistics(results)
+        self.assertEqual(cpu["cpu_seconds_per_gb"], 3.0)
+        self.assertEqual(cpu["unit_system"], 3.0)
+        self.assertEqual(cpu["iowait"], 60.0)
+        self.assertAlmostEqual(cpu["softirq"], 100 / 30)
+        self.assertIsNone(
+            usb_read_write.cpu_statistics(
+                [usb_read_write.IOResult(1, 1.0, 1e-6)]
+            )
+        )
+
+    def test_relative_confidence_interval(self):
+        self.assertEqual(
+            usb_read_write.relative_confidence_interval([10.0]), float("inf")
+        )
+        self.assertEqual(
+            usb_read_write.relative_confidence_interval([10.0] * 3), 0.0
+        )
+        # mean 10, stdev 1, t = 4.303 with 2 degrees of freedom
+        self.assertAlmostEqual(
+            usb_read_write.relative_confidence_interval([9.0, 10.0, 11.0]),
+            4.303 / 3**0.5 / 10,
+        )
+
+    def test_find_cache_boundary(self):
+        fast = [usb_read_write.Sample(i, i, 100.0) for i in range(10)]
+        slow = [usb_read_write.Sample(i, i, 30.0) for i in range(10, 30)]
+        self.assertEqual(
+            usb_read_write.find_cache_boundary(fast + slow), (10, 100.0, 30.0)
+        )
+        self.assertEqual(
+            usb_read_write.find_cache_boundary(fast), (None, 100.0, 100.0)
+        )
+
+    @patch("usb_read_write.subprocess.run")
+    def test_dd_write(self, mock_run):
+        outputs = [
+            # GNU coreutils, the speed unit depends on the speed
+            "2048+0 records in\n2048+0 records out\n"
+            "2097152 bytes (2.1 MB, 2.0 MiB) copied, 0.5 s, 4.2 MB/s\n",
+            "2048+0 records in\n2048+0 records out\n"
+            "2097152 bytes (2.1 MB, 2.0 MiB) copied, 5 s, 419 kB/s\n",
+            # busybox
+            "2048+0 records in\n2048+0 records out\n"
+            "2097152 bytes (2.0MB) copied, 0.500000 seconds, 4.0MB/s\n",
+        ]
+        for output, seconds in zip(outputs, (0.5, 5.0, 0.5)):
+            mock_run.return_value = subprocess.CompletedProcess(
+                [], 0, output.encode()
+            )
+            result = usb_read_write.dd_write("source", "target", 1024, "")
+            self.assertEqual(result.bytes, 2097152)
+            self.assertEqual(result.seconds, seconds)
+            self.assertAlmostEqual(result.speed, 2.097152 / seconds)
+        self.assertEqual(mock_run.call_args.kwargs["env"]["LC_ALL"], "C")
+        mock_run.return_value = subprocess.CompletedProcess(
+            [],
+            1,
+            b"dd: error writing 'target': Input/output error\n"
+            b"38913+0 records in\n38912+0 records out\n"
+            b"19922944 bytes (20 MB, 19 MiB) copied, 99.6 s, 200 kB/s\n",
+        )
+        with self.assertRaises(OSError):
+            usb_read_write.dd_write("source", "target", 512, "sync")
+
+    def test_native_write(self):
+        random_file = usb_read_write.RandomData(300000, streamed=True)
+        with tempfile.TemporaryDirectory() as folder:
+            target = os.path.join(folder, "target")
+            result = usb_read_write.native_write(
+                random_file, target, 65536, ""
+            )
+            self.assertEqual(result.bytes, 300000)
+            self.assertIsNone(
+                usb_read_write.compare_with_source(target, random_file, 4096)
+            )
+
+    def test_file_write_engines(self):
+        random_file = usb_read_write.RandomData(300000)
+        with tempfile.TemporaryDirectory() as folder:
+            target = os.path.join(folder, "target")
+            for engine in ("userspace", "sendfile"):
+                result = usb_read_write.WRITE_ENGINES[engine](
+                    random_file, target, 65536, ""
+                )
+                self.assertEqual(result.bytes, 300000)
+                self.assertIsNotNone(result.cpu_seconds)
+                self.assertIsNone(
+                    usb_read_write.compare_with_source(
+                        target, random_file, 4096
+                    )
+                )
+        os.unlink(random_file.tfile.name)
+        streamed = usb_read_write.RandomData(4096, streamed=True)
+        with self.assertRaises(ValueError):
+            usb_read_write.sendfile_write(streamed, "target", 4096, "")
+
+    def test_buffered_speed(self):
+        result = usb_read_write.BufferedResult(4 * 10**6, 1.0, 2.0, 0.5)
+        self.assertEqual(usb_read_write.buffered_speed(result, False), 4.0)
+        self.assertAlmostEqual(usb_read_write.buffered_speed(result), 4 / 3.5)
+        result = result._replace(umount_seconds=0.5)
+        self.assertEqual(usb_read_write.buffered_speed(result), 1.0)
+
+    def test_commit_latency(self):
+        with tempfile.TemporaryDirectory() as folder:
+            target = os.path.join(folder, "commits")
+            result = usb_read_write.commit_latency(
+                target, [4096, 16384], 5, "fdatasync"
+            )
+            self.assertEqual(os.path.getsize(target), 3 * 4096 + 2 * 16384)
+        self.assertEqual(result.commits, 5)
+        self.assertEqual(len(result.latencies), 5)
+
+    def test_latency_histogram(self):
+        self.assertEqual(
+            usb_read_write.latency_histogram([0.0001, 0.00011, 0.0004]),
+            [(0.000128, 2), (0.000256, 0), (0.000512, 1)],
+        )
+
+    def test_metadata_workload(self):
+        with tempfile.TemporaryDirectory() as folder:
+            results = usb_read_write.metadata_workload(
+                folder, b"payload", 50, 4, 3
+            )
+            # 4 files per folder, the files are removed but not the folders
+            self.assertEqual(sorted(os.listdir(folder)), ["0", "1", "2", "3"])
+            self.assertEqual(os.listdir(os.path.join(folder, "3")), ["0"])
+            self.assertEqual(os.listdir(os.path.join(folder, "3", "0")), [])
+        self.assertEqual(
+            [result.phase for result in results],
+            ["create", "fsync", "stat", "read", "unlink"],
+        )
+        self.assertTrue(all(result.ops == 50 for result in results))
+        with tempfile.TemporaryDirectory() as folder:
+            usb_read_write.metadata_workload(folder, b"payload", 100, 4, 1)
+            # a third level keeps the top one within the fanout
+            self.assertEqual(sorted(os.listdir(folder)), ["0", "1"])
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(folder, "1"))),
+                ["0", "1", "2"],
+            )
+
+    def test_mount_info(self):
+        with tempfile.NamedTemporaryFile("w") as mountinfo:
+            mountinfo.write(
+                "23 28 0:22 / /proc rw,relatime - proc proc rw\n"
+                "43 28 8:17 / /media/my\\040usb rw,relatime shared:1 - "
+                "vfat /dev/sdb1 rw,fmask=0022\n"
+                "44 28 8:17 /sub /srv rw,relatime - vfat /dev/sdb1 rw\n"
+            )
+            mountinfo.flush()
+            mounts = usb_read_write.mount_info(mountinfo.name)
+        self.assertEqual(len(mounts), 3)
+        self.assertEqual(mounts[1].device, (8, 17))
+        self.assertEqual(mounts[1].mount_point, "/media/my usb")
+        self.assertEqual(mounts[1].fs_type, "vfat")
+        self.assertEqual(mounts[1].super_options, {"rw", "fmask=0022"})
+        with patch("usb_read_write.os.access", return_value=True):
+            self.assertEqual(
+                usb_read_write.find_reusable_mount((8, 17), mounts),
+                mounts[1],
+            )
+            self.assertIsNone(
+                usb_read_write.find_reusable_mount((8, 33), mounts)
+            )
+            read_only = mounts[1]._replace(options={"ro"})
+            self.assertIsNone(
+                usb_read_write.find_reusable_mount((8, 17), [read_only])
+            )
+
+    def test_io_stat_sampler_stats(self):
+        sampler = usb_read_write.IoStatSampler([], 0.1)
+        sampler.paths = {"sdb": "/sys/class/block/sdb/stat"}
+        sampler.samples = [
+            (10.0, {"sdb": [0, 0, 0, 0, 100, 0, 2048, 0, 0, 1000, 2000]}),
+            (10.5, {"sdb": [0, 0, 0, 0, 150, 0, 4096, 0, 2, 1200, 2500]}),
+            (12.0, {"sdb": [0, 0, 0, 0, 200, 0, 6144, 0, 0, 2000, 5000]}),
+        ]
+        stats = sampler.stats()["sdb"]
+        self.assertEqual(stats.write_bytes, 4096 * 512)
+        self.assertEqual(stats.read_bytes, 0)
+        self.assertAlmostEqual(stats.speed, 4096 * 512 / 2 / 1e6)
+        self.assertEqual(stats.request_size, 4096 * 512 / 100)
+        self.assertEqual(stats.queue_depth, 1.5)
+        self.assertEqual(stats.max_in_flight, 2)
+        self.assertEqual(stats.utilization, 50.0)
+
+
+class TestConfig(unittest.TestCase):
+    def test_defaults(self):
+        config = usb_read_write.Config({})
+        self.assertEqual(config.partitions, [])
+        self.assertEqual(config.write_engine, "native")
+        self.assertEqual(config.block_size, "1M")
+        self.assertEqual(config.queue_depths, ["1"])
+        # the native engine writes the test data from memory
+        self.assertTrue(config.streamed)
+        config = usb_read_write.Config({"USB_RWTEST_WRITE_ENGINE": "dd"})
+        self.assertFalse(config.streamed)
+
+    def test_environ(self):
+        config = usb_read_write.Config(
+            {
+                "USB_RWTEST_PARTITIONS": "sdb1 sdc1",
+                "USB_RWTEST_SWEEP": "4K 1M",
+                "USB_RWTEST_VERIFY_WORKERS": "4",
+            }
+        )
+        self.assertEqual(config.partitions, ["sdb1", "sdc1"])
+        self.assertEqual(config.sweep_block_sizes, ["4K", "1M"])
+        self.assertEqual(config.verify_workers, 4)
+
+    def test_mode(self):
+        self.assertEqual(usb_read_write.Config({}).mode(), "serial")
+        config = usb_read_write.Config(
+            {"USB_RWTEST_SWEEP": "4K 1M", "USB_RWTEST_PIPELINED": "1"}
+        )
+        self.assertEqual(config.mode(), "sweep")
+        config = usb_read_write.Config(
+            {"USB_RWTEST_BUFFERED": "1", "USB_RWTEST_STREAMS": "1 2"}
+        )
+        with self.assertRaisesRegex(ValueError, "scaling, buffered"):
+            config.mode()
+        config = usb_read_write.Config(
+            {"USB_RWTEST_METADATA": "1", "USB_RWTEST_ADAPTIVE": "1"}
+        )
+        with self.assertRaisesRegex(ValueError, "USB_RWTEST_ADAPTIVE"):
+            config.mode()
+        config = usb_read_write.Config(
+            {"USB_RWTEST_PIPELINED": "1", "USB_RWTEST_VERIFY_WORKERS": "2"}
+        )
+        with self.assertRaisesRegex(ValueError, "VERIFY_WORKERS"):
+            config.mode()
+
+    def test_mode_flags(self):
+        config = usb_read_write.Config({"USB_RWTEST_READ_IFLAG": "nocache"})
+        with self.assertRaisesRegex(ValueError, "USB_RWTEST_READ_IFLAG"):
+            config.mode()
+        config = usb_read_write.Config({"USB_RWTEST_WRITE_OFLAG": "fsync"})
+        with self.assertRaisesRegex(ValueError, "USB_RWTEST_WRITE_OFLAG"):
+            config.mode()
+        config = usb_read_write.Config(
+            {
+                "USB_RWTEST_WRITE_ENGINE": "dd",
+                "USB_RWTEST_WRITE_OFLAG": "fsync",
+            }
+        )
+        self.assertEqual(config.mode(), "serial")
+
+    def test_mode_verify(self):
+        config = usb_read_write.Config({"USB_RWTEST_VERIFY": "sha1"})
+        with self.assertRaisesRegex(ValueError, "unknown verification"):
+            config.mode()
+        config = usb_read_write.Config(
+            {
+                "USB_RWTEST_VERIFY": "crc32",
+                "USB_RWTEST_VERIFY_CHUNK_SIZE": "0",
+            }
+        )
+        with self.assertRaisesRegex(ValueError, "CHUNK_SIZE"):
+            config.mode()
+        config = usb_read_write.Config({"USB_RWTEST_VERIFY": "blake2b"})
+        self.assertEqual(config.mode(), "serial")
+
+    @patch("usb_read_write.os.sysconf", return_value=1024)
+    def test_low_memory(self, mock_sysconf):
+        config = usb_read_write.Config({"USB_RWTEST_WRITE_ENGINE": "dd"})
+        self.assertEqual(config.file_size, 20971520)
+        # the metadata workload writes its own data
+        config = usb_read_write.Config(
+            {"USB_RWTEST_WRITE_ENGINE": "dd", "USB_RWTEST_METADATA": "1"}
+        )
+        self.assertEqual(config.file_size, 104857600)
+        self.assertEqual(usb_read_write.Config({}).file_size, 104857600)
+
+    @patch("usb_read_write.tempfile.mkdtemp")
+    def test_no_mount_folder_until_used(self, mock_mkdtemp):
+        mock_mkdtemp.return_value = "/mnt/tmpfolder"
+        test = usb_read_write.UsbRwTest(usb_read_write.Config({}))
+        mock_mkdtemp.assert_not_called()
+        self.assertEqual(test.folder_to_mount, "/mnt/tmpfolder")
+        self.assertEqual(test.folder_to_mount, "/mnt/tmpfolder")
+        mock_mkdtemp.assert_called_once_with(dir="/mnt/")
+
+
+class TestWriteTestUnit(unittest.TestCase):
+    @patch("usb_read_write.block_devices", return_value=["sdz1", "sdz"])
+    @patch("usb_read_write.KernelLogScanner")
+    def test_closes_own_log_scanner(self, mock_scanner, mock_devices):
+        mock_scanner.return_value.scan.return_value = []
+        test = usb_read_write.UsbRwTest(usb_read_write.Config({}))
+        random_file = usb_read_write.RandomData(4096, streamed=True)
+        with tempfile.TemporaryDirectory() as folder:
+            result = test.write_test_unit(random_file, "0", folder)
+            self.assertEqual(result.bytes, 4096)
+            mock_scanner.return_value.close.assert_called_once_with()
+            # a scanner given by the caller is left open
+            log_scanner = mock_scanner.return_value
+            log_scanner.close.reset_mock()
+            test.write_test_unit(random_file, "1", folder, None, log_scanner)
+            log_scanner.close.assert_not_called()
+
+
+class TestReadTest(unittest.TestCase):
+    @patch("usb_read_write.UsbRwTest.verify_read_unit")
+    @patch("usb_read_write.UsbRwTest.timed_read_unit")
+    def test_timed_reads_are_serial(self, mock_timed, mock_verify):
+        threads = []
+
+        def timed_read_unit(random_file, idx, folder, block_size):
+            threads.append(threading.current_thread())
+            return "path" + idx, usb_read_write.IOResult(1, 1.0, 1e-6)
+
+        mock_timed.side_effect = timed_read_unit
+        mock_verify.side_effect = lambda random_file, path, result, size: (
+            result
+        )
+        config = usb_read_write.Config({"USB_RWTEST_VERIFY_WORKERS": "4"})
+        test = usb_read_write.UsbRwTest(config)
+        results = test.read_test("random_file", "/mnt/folder", 4096, 3)
+        self.assertEqual(len(results), 3)
+        # only the verification runs in the workers
+        self.assertEqual(threads, [threading.current_thread()] * 3)
+        self.assertEqual(
+            [c.args[1] for c in mock_verify.call_args_list],
+            ["path0", "path1", "path2"],
+        )
+
+
+@patch("usb_read_write.block_devices", return_value=["sdb1", "sdb"])
+@patch("usb_read_write.KernelLogScanner")
+@patch("usb_read_write.UsbRwTest.read_test_unit")
+@patch("usb_read_write.UsbRwTest.write_test_unit")
+class TestPipelinedTest(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def unit(self, operation):
+        def unit(random_file, idx, folder, block_size, *args):
+            with self.lock:
+                self.events.append((operation, idx, "start"))
+            time.sleep(0.05)
+            with self.lock:
+                self.events.append((operation, idx, "end"))
+            return usb_read_write.IOResult(1000, 0.05, 0.02)
+
+        return unit
+
+    def test_pipeline(self, mock_write, mock_read, mock_scanner, mock_devices):
+        mock_write.side_effect = self.unit("write")
+        mock_read.side_effect = self.unit("read")
+        test = usb_read_write.UsbRwTest(usb_read_write.Config({}))
+        with patch("builtins.print") as mock_print:
+            writes, reads = test.pipelined_test("random_file", "/mnt/folder")
+        self.assertEqual((len(writes), len(reads)), (5, 5))
+        # every file is read once written, the reads never overlap
+        for idx in map(str, range(5)):
+            self.assertLess(
+                self.events.index(("write", idx, "end")),
+                self.events.index(("read", idx, "start")),
+            )
+        reads = [event for event in self.events if event[0] == "read"]
+        self.assertEqual(
+            [event[1:] for event in reads],
+            [
+                (str(idx), edge)
+                for idx in range(5)
+                for edge in ("start", "end")
+            ],
+        )
+        # the reads overlap the writes
+        overlap = next(
+            call.args[0]
+            for call in mock_print.call_args_list
+            if call.args[0].startswith("Pipelined")
+        )
+        percent = float(re.search(r"([0-9.]+)% of the", overlap).group(1))
+        self.assertGreater(percent, 20)
+        mock_scanner.return_value.close.assert_called_once_with()
+
+    def test_plan_stops_early(
+        self, mock_write, mock_read, mock_scanner, mock_devices
+    ):
+        mock_write.side_effect = self.unit("write")
+        mock_read.side_effect = self.unit("read")
+        test = usb_read_write.UsbRwTest(usb_read_write.Config({}))
+        plan = usb_read_write.TestPlan(1000, 10)
+        with patch.object(
+            test,
+            "precise_enough",
+            side_effect=lambda results: len(results) == 3,
+        ), patch("builtins.print"):
+            writes, reads = test.pipelined_test(
+                "random_file", "/mnt/folder", plan=plan
+            )
+        self.assertEqual((len(writes), len(reads)), (3, 3))
+
+
+class MountTestCase(unittest.TestCase):
+    """
+    Base class of the tests running the units on temporary folders
+    standing for the mounted partitions, the partitions listed in failing
+    cannot be mounted.
+    """
+
+    failing = ()
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = root.name
+        self.random_file = usb_read_write.RandomData(300000, streamed=True)
+        self.config = usb_read_write.Config({})
+        self.config.repetition_num = 2
+        self.config.block_size = "64K"
+        mocks = []
+        for patcher in (
+            patch("usb_read_write.mount_usb_storage", new=self.mount),
+            # the mount points are created in /mnt
+            patch("usb_read_write.tempfile.mkdtemp", side_effect=self.mkdtemp),
+            patch("usb_read_write.KernelLogScanner"),
+            patch("builtins.print"),
+        ):
+            mocks.append(patcher.start())
+            self.addCleanup(patcher.stop)
+        _, _, mock_scanner, self.mock_print = mocks
+        # no I/O errors in the kernel log
+        mock_scanner.return_value.scan.return_value = []
+
+    def mkdtemp(self, dir, prefix="tmp"):
+        folder = os.path.join(self.root, prefix + "mnt")
+        os.mkdir(folder)
+        return folder
+
+    @contextlib.contextmanager
+    def mount(self, partition, folder, metrics=None):
+        if partition in self.failing:
+            sys.exit(1)
+        mount_point = os.path.join(self.root, partition)
+        os.makedirs(mount_point, exist_ok=True)
+        yield mount_point
+
+    def printed(self):
+        return [call.args[0] for call in self.mock_print.call_args_list]
+
+
+class TestParallelTest(MountTestCase):
+    failing = ("sdc1",)
+
+    def test_parallel(self):
+        test = usb_read_write.UsbRwTest(self.config)
+        results = test.parallel_test(self.random_file, ["sdb1", "sdd1"])
+        self.assertEqual([r.partition for r in results], ["sdb1", "sdd1"])
+        for result in results:
+            self.assertEqual(len(result.write), 2)
+            self.assertEqual(len(result.read), 2)
+            self.assertEqual(result.write[0].bytes, 300000)
+        # the files were removed once verified, and the mount points once
+        # unmounted
+        self.assertEqual(os.listdir(os.path.join(self.root, "sdb1")), [])
+        self.assertEqual(sorted(os.listdir(self.root)), ["sdb1", "sdd1"])
+
+    def test_failing_partition(self):
+        test = usb_read_write.UsbRwTest(self.config)
+        with self.assertLogs(level="ERROR") as logs, self.assertRaises(
+            SystemExit
+        ):
+            test.parallel_test(self.random_file, ["sdb1", "sdc1"])
+        self.assertIn("sdc1 failed", logs.output[0])
+        # the other partition was tested to the end
+        printed = self.printed()
+        self.assertIn("  sdc1: FAIL", printed)
+        self.assertTrue(
+            any(line.startswith("  sdb1: write ") for line in printed)
+        )
+
+
+class TestBlockSizeSweep(MountTestCase):
+    def test_sweep(self):
+        native_write = MagicMock(wraps=usb_read_write.native_write)
+        test = usb_read_write.UsbRwTest(self.config)
+        with patch.dict(
+            usb_read_write.WRITE_ENGINES, {"native": native_write}
+        ), patch(
+            "usb_read_write.timed_read", wraps=usb_read_write.timed_read
+        ) as timed_read:
+            table = test.block_size_sweep(
+                self.random_file, "sdb1", ["4K", "64K"]
+            )
+        self.assertEqual(
+            [block_size for block_size, _ in table], ["4K", "64K"]
+        )
+        for _, result in table:
+            self.assertEqual(result.partition, "sdb1")
+            self.assertEqual(len(result.write), 2)
+            self.assertEqual(len(result.read), 2)
+        # the files are written and read with every block size in turn
+        self.assertEqual(
+            [c.args[2] for c in native_write.call_args_list],
+            [4096, 4096, 65536, 65536],
+        )
+        self.assertEqual(
+            [c.args[1] for c in timed_read.call_args_list],
+            [4096, 4096, 65536, 65536],
+        )
+        self.assertIn("Throughput of sdb1 by block size:", self.printed())
+
+    def test_invalid_block_size(self):
+        test = usb_read_write.UsbRwTest(self.config)
+        with self.assertLogs(level="ERROR"), self.assertRaises(SystemExit):
+            test.block_size_sweep(self.random_file, "sdb1", ["4K", "4X"])
+        self.assertEqual(os.listdir(self.root), [])
+
+
+class TestResultsReport(MountTestCase):
+    def test_partition_report(self):
+        test = usb_read_write.UsbRwTest(self.config)
+        result = test.partition_test(self.random_file, "sdb1")
+        report = usb_read_write.partition_report(result)
+        self.assertEqual(report["partition"], "sdb1")
+        for direction in ("write", "read"):
+            self.assertEqual(len(report[direction]["units"]), 2)
+            unit = report[direction]["units"][0]
+            self.assertEqual(unit["bytes"], 300000)
+            self.assertIn("unit_user", unit["cpu_usage"])
+            summary = report[direction]["summary"]
+            self.assertLessEqual(summary["min"], summary["median"])
+            self.assertLessEqual(summary["median"], summary["max"])
+
+    def test_save_results(self):
+        self.config.partitions = ["sdb1"]
+        self.config.file_size = 300000
+        self.config.session_share = self.root
+        usb_read_write.UsbRwTest(self.config).run()
+        with open(
+            os.path.join(self.root, usb_read_write.RESULTS_FILE)
+        ) as results_file:
+            report = json.load(results_file)
+        self.assertEqual(report["mode"], "serial")
+        self.assertEqual(report["config"]["repetition_num"], 2)
+        self.assertEqual(report["config"]["block_size"], "64K")
+        self.assertLessEqual(report["start_time"], report["end_time"])
+        self.assertEqual(
+            [device["partition"] for device in report["devices"]], ["sdb1"]
+        )
+        self.assertEqual(
+            [unit["bytes"] for unit in report["devices"][0]["read"]["units"]],
+            [300000, 300000],
+        )
+
+
+class TestAggregateBandwidth(unittest.TestCase):
+    @patch("usb_read_write.os.path.realpath")
+    def test_host_controller(self, mock_realpath):
+        mock_realpath.return_value = (
+            "/sys/devices/pci0000:00/0000:00:14.0/usb2/2-1/2-1:1.0/host0/"
+            "target0:0:0/0:0:0:0/block/sdb/sdb1"
+        )
+        self.assertEqual(
+            usb_read_write.host_controller("sdb1"), "0000:00:14.0"
+        )
+        mock_realpath.return_value = (
+            "/sys/devices/pci0000:00/0000:00:17.0/ata1/host0/target0:0:0/"
+            "0:0:0:0/block/sda/sda1"
+        )
+        self.assertEqual(usb_read_write.host_controller("sda1"), "unknown")
+
+    @patch("usb_read_write.host_controller")
+    @patch("builtins.print")
+    def test_report(self, mock_print, mock_host_controller):
+        controllers = {"sdb1": "xhci", "sdc1": "ehci", "sdd1": "xhci"}
+        mock_host_controller.side_effect = controllers.get
+
+        def result(partition, write, read):
+            return usb_read_write.PartitionResult(
+                partition,
+                [usb_read_write.IOResult(1, 1, write)],
+                [usb_read_write.IOResult(1, 1, read)],
+            )
+
+        usb_read_write.report_aggregate_bandwidth(
+            [
+                result("sdb1", 40.0, 80.0),
+                result("sdc1", 20.0, 30.0),
+                result("sdd1", 40.0, 80.0),
+            ],
+            [
+                result("sdb1", 20.0, 40.0),
+                result("sdc1", 20.0, 30.0),
+                result("sdd1", 30.0, 40.0),
+            ],
+        )
+        self.assertEqual(
+            [call.args[0] for call in mock_print.call_args_list],
+            [
+                "Host controller xhci (sdb1 sdd1):",
+                "  aggregate write speed: 50.000 MB/s concurrently, "
+                "80.000 MB/s one by one (62.5%)",
+                "  aggregate read speed: 80.000 MB/s concurrently, "
+                "160.000 MB/s one by one (50.0%)",
+                "Host controller ehci (sdc1):",
+                "  aggregate write speed: 20.000 MB/s concurrently, "
+                "20.000 MB/s one by one (100.0%)",
+                "  aggregate read speed: 30.000 MB/s concurrently, "
+                "30.000 MB/s one by one (100.0%)",
+            ],
+        )
+
+
+class TestInvalidSettings(unittest.TestCase):
+    @patch("usb_read_write.mount_usb_storage")
+    def test_no_commits(self, mock_mount):
+        config = usb_read_write.Config(
+            {"USB_RWTEST_COMMIT_LATENCY": "1", "USB_RWTEST_COMMITS": "0"}
+        )
+        test = usb_read_write.UsbRwTest(config)
+        with self.assertRaises(SystemExit):
+            test.commit_latency_test("sdb1")
+        mock_mount.assert_not_called()
+
+    @patch("usb_read_write.mount_usb_storage")
+    def test_no_random_io_ops(self, mock_mount):
+        config = usb_read_write.Config(
+            {"USB_RWTEST_RANDOM_IO": "1", "USB_RWTEST_RANDOM_IO_OPS": "0"}
+        )
+        test = usb_read_write.UsbRwTest(config)
+        with self.assertRaises(SystemExit):
+            test.random_io_test(None, "sdb1")
+        mock_mount.assert_not_called()
+
+    @patch("usb_read_write.mount_usb_storage")
+    def test_no_streams(self, mock_mount):
+        for counts in ("0", "1 -2"):
+            config = usb_read_write.Config({"USB_RWTEST_STREAMS": counts})
+            test = usb_read_write.UsbRwTest(config)
+            with self.assertRaises(SystemExit):
+                test.scaling_test(None, "sdb1")
+        mock_mount.assert_not_called()
+
+
+class TestKernelLogScanner(unittest.TestCase):
+    def setUp(self):
+        journal = MagicMock()
+        self.reader = journal.Reader.return_value
+        systemd = MagicMock(journal=journal)
+        patcher = patch.dict(
+            sys.modules, {"systemd": systemd, "systemd.journal": journal}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_scan(self):
+        scanner = usb_read_write.KernelLogScanner(["sdb1", "sdb"])
+        self.reader.seek_tail.assert_called_once_with()
+        self.reader.__iter__.return_value = iter(
+            [
+                {"MESSAGE": "usb 2-1: new SuperSpeed USB device number 3"},
+                {"MESSAGE": "blk_update_request: I/O error, dev sdb, "},
+                {"MESSAGE": "blk_update_request: I/O error, dev sdc, "},
+                {"MESSAGE": "Buffer I/O error on dev sdb1, logical block 0"},
+            ]
+        )
+        with self.assertLogs(level="WARNING") as logs:
+            errors = scanner.scan()
+        self.assertEqual(
+            errors,
+            [
+                "blk_update_request: I/O error, dev sdb, ",
+                "Buffer I/O error on dev sdb1, logical block 0",
+            ],
+        )
+        # the errors of other devices are only logged
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("dev sdc", logs.output[0])
+        self.reader.__iter__.return_value = iter([])
+        self.assertEqual(scanner.scan(), [])
+        scanner.close()
+        self.reader.close.assert_called_once_with()
+
+    def test_check_io_errors(self):
+        scanner = usb_read_write.KernelLogScanner(["sdb1", "sdb"])
+        self.reader.__iter__.return_value = iter([])
+        usb_read_write.check_io_errors(scanner)
+        self.reader.__iter__.return_value = iter(
+            [{"MESSAGE": "blk_update_request: I/O error, dev sdb, "}]
+        )
+        with patch("builtins.print") as mock_print, self.assertRaises(
+            SystemExit
+        ):
+            usb_read_write.check_io_errors(scanner)
+        mock_print.assert_any_call("ERROR: I/O errors found in dmesg")
+
+
+class TestBaseline(unittest.TestCase):
+    def setUp(self):
+        session_share = tempfile.TemporaryDirectory()
+        self.addCleanup(session_share.cleanup)
+        self.config = usb_read_write.Config({})
+        self.config.session_share = session_share.name
+
+    def result(self, write_speed, read_speed):
+        return usb_read_write.PartitionResult(
+            "sdb1",
+            [usb_read_write.IOResult(1, 1, write_speed)],
+            [usb_read_write.IOResult(1, 1, read_speed)],
+        )
+
+    @patch("usb_read_write.usb_device_identity")
+    def test_regression(self, mock_identity):
+        mock_identity.return_value = {
+            "vendor": "0781",
+            "product": "5581",
+            "serial": "4C53",
+        }
+        test = usb_read_write.UsbRwTest(self.config)
+        # the first run of a device has no baseline
+        self.assertEqual(
+            test.compare_with_baseline(
+                "serial", [("1M", self.result(100.0, 200.0))]
+            ),
+            [],
+        )
+        for speed in (90.0, 110.0):
+            comparisons = test.compare_with_baseline(
+                "serial", [("1M", self.result(speed, 200.0))]
+            )
+            self.assertEqual(len(comparisons), 2)
+        comparisons = test.compare_with_baseline(
+            "serial", [("1M", self.result(70.0, 190.0))]
+        )
+        self.assertEqual(
+            [(c["direction"], c["baseline"]) for c in comparisons],
+            [("write", 100.0), ("read", 200.0)],
+        )
+        self.assertEqual([c["regressed"] for c in comparisons], [True, False])
+        # a regressed run does not lower the baseline
+        comparisons = test.compare_with_baseline(
+            "serial", [("1M", self.result(100.0, 200.0))]
+        )
+        self.assertEqual(comparisons[0]["runs"], 3)
+        # other configurations have their own baseline
+        self.assertEqual(
+            test.compare_with_baseline(
+                "serial", [("4K", self.result(1.0, 2.0))]
+            ),
+            [],
+        )
+
+    @patch("usb_read_write.usb_device_identity", return_value=None)
+    def test_not_usb(self, mock_identity):
+        test = usb_read_write.UsbRwTest(self.config)
+        self.assertEqual(
+            test.compare_with_baseline("serial", [("1M", self.result(1, 1))]),
+            [],
+        )
+
+
+class TestUsbLink(unittest.TestCase):
+    # the BOS descriptor of a USB 3 device: a USB 2.0 extension and a
+    # SuperSpeed capability
+    BOS = bytes(
+        (5, 0x0F, 22, 0, 2)
+        + (7, 0x10, 0x02, 0x02, 0, 0, 0)
+        + (10, 0x10, 0x03, 0, 0x0E, 0, 1, 0x0A, 0xFF, 0x07)
+    )
+
+    def setUp(self):
+        sysfs = tempfile.TemporaryDirectory()
+        self.addCleanup(sysfs.cleanup)
+        # a USB 3 device enumerated at high speed on the high speed root
+        # hub of an xHCI controller, its bcdUSB is 2.10
+        controller = os.path.join(sysfs.name, "0000:00:14.0")
+        self.device = os.path.join(controller, "usb1", "1-1")
+        os.makedirs(self.device)
+        os.makedirs(os.path.join(controller, "usb2"))
+        for path, attribute, value in (
+            (self.device, "speed", "480\n"),
+            (self.device, "version", " 2.10\n"),
+            (os.path.dirname(self.device), "speed", "480\n"),
+            (os.path.join(controller, "usb2"), "speed", "5000\n"),
+        ):
+            with open(os.path.join(path, attribute), "w") as f:
+                f.write(value)
+        with open(os.path.join(self.device, "bos_descriptors"), "wb") as f:
+            f.write(self.BOS)
+
+    def test_usb_link(self):
+        with patch("usb_read_write.usb_device_path", return_value=self.device):
+            self.assertEqual(
+                usb_read_write.usb_link("sdb1"),
+                {
+                    "device": "1-1",
+                    "speed": 480.0,
+                    "version": "2.10",
+                    "descriptor_speed": 5000,
+                    "hub_speed": 480.0,
+                    "controller_speed": 5000.0,
+                },
+            )
+
+    def test_usb_link_usb2(self):
+        # a USB 2 device has no SuperSpeed capability, older kernels do not
+        # expose the BOS descriptor at all
+        with open(os.path.join(self.device, "bos_descriptors"), "wb") as f:
+            f.write(self.BOS[:12])
+        with patch("usb_read_write.usb_device_path", return_value=self.device):
+            self.assertEqual(
+                usb_read_write.usb_link("sdb1")["descriptor_speed"], 480
+            )
+            os.unlink(os.path.join(self.device, "bos_descriptors"))
+            self.assertEqual(
+                usb_read_write.usb_link("sdb1")["descriptor_speed"], 480
+            )
+
+    def test_check_links(self):
+        test = usb_read_write.UsbRwTest(usb_read_write.Config({}))
+        result = usb_read_write.PartitionResult(
+            "sdb1",
+            [usb_read_write.IOResult(1, 1, 3.0)],
+            [usb_read_write.IOResult(1, 1, 30.0)],
+        )
+        with patch(
+            "usb_read_write.usb_device_path", return_value=self.device
+        ), self.assertLogs(level="WARNING") as logs:
+            links = test.check_links([("1M", result)])
+        self.assertEqual(links[0]["read"]["utilization"], 50.0)
+        self.assertEqual(links[0]["read"]["practical_utilization"], 75.0)
+        # the USB 3 device runs at high speed, its best speed is fine
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("descriptor supports 5000", logs.output[0])
+        self.assertIn("check the port", logs.output[0])